@@ -1,24 +1,92 @@
-import httpx, json, re, random, os, asyncio, time, secrets, threading, sys
+import httpx, json, re, random, os, asyncio, time, secrets, threading, sys, queue, atexit, contextvars, uuid
 from urllib.parse import quote
 from datetime import datetime, timedelta
-from typing import Optional, List, Tuple, Dict, Any
-from fastapi import FastAPI, HTTPException, Depends, Request, Body, Response
+from typing import Optional, List, Tuple, Dict, Any, Union, Literal
+from typing_extensions import Annotated  # Python 3.8的typing没有Annotated
+from fastapi import FastAPI, HTTPException, Depends, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
+from fastapi.exception_handlers import http_exception_handler
+from starlette.exceptions import HTTPException as StarletteHTTPException
+from starlette.datastructures import Headers, MutableHeaders
 from fastapi.templating import Jinja2Templates
-from pydantic import BaseModel, validator
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError, field_validator
 import uvicorn
 import math
 import base64
 import hashlib
+import csv
+import io
+import zlib
+import bisect
+import gzip
+import shutil
+import functools
 from urllib.parse import urlparse
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager, contextmanager
+
+# 可选的高速JSON库，未安装时使用标准库json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+# 可选的brotli压缩，未安装时只使用gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # ==================== 配置 ====================
 MISTAKE_TURN_TYPE = False  # 是否提高教词容错率，中文符自动转成英文符
 API_HOST = "0.0.0.0"  # 监听所有网络接口
 API_PORT = 8889  # API端口
 API_TOKEN = secrets.token_hex(16)  # 生成随机token
+LOG_LEVEL = "INFO"  # 日志最低级别：DEBUG/INFO/WARN/ERROR
+LOG_SUBSYSTEM_LEVELS = {}  # 子系统单独的日志级别，如 {"query": "DEBUG"}，子系统：query/decode/io/http
+LOG_CONSOLE = True  # 日志是否同时输出到控制台
+LOG_FORMAT = "text"  # 日志格式：text为文本行，json为每行一个JSON对象（带请求ID和各阶段耗时）
+LOG_BATCH_SIZE = 256  # 后台写日志时每批最多写入的条数
+LOG_MAX_BYTES = 10 * 1024 * 1024  # api_log.txt超过该大小时轮转，0为不按大小轮转
+LOG_ROTATE_DAILY = True  # 是否每天轮转一次日志
+LOG_BACKUP_COUNT = 7  # 保留的历史日志文件数
+LOG_COMPRESS = True  # 是否在后台用gzip压缩轮转后的日志
+JSON_BACKEND = "auto"  # JSON库：auto/orjson/msgspec/json，所选库未安装时自动回退到json
+LEXICON_JSON_INDENT = 4  # 词库文件缩进（使用标准库json写入），0为紧凑格式（使用高速JSON库，更小更快）
+BATCH_MAX_ITEMS = 100  # 批量接口单次最多处理的操作数
+WS_MAX_INFLIGHT = 32  # 每个WebSocket连接同时处理的最大请求数，超出后暂停读取
+LIST_DEFAULT_LIMIT = 100  # list操作默认每页词条数
+LIST_MAX_LIMIT = 1000  # list操作每页最多词条数
+IMPORT_MAX_ERRORS = 20  # 导入校验失败时最多返回的错误数
+METRICS_ENABLED = True  # 是否开放Prometheus监控接口 /metrics
+COMPRESS_RESPONSES = True  # 是否压缩响应（按Accept-Encoding选择brotli/gzip）
+COMPRESS_MIN_SIZE = 1024  # 小于该字节数的响应不压缩
+COMPRESS_GZIP_LEVEL = 6  # gzip压缩级别（1-9）
+COMPRESS_BROTLI_QUALITY = 5  # brotli压缩质量（0-11，需要安装brotli）
+DECODE_CACHE_SIZE = 1024  # 静态回复解码结果缓存条数，0为关闭
+TRANSCODE_CACHE_SIZE = 1024  # CQ码转码结果缓存条数，0为关闭
+HTTP_CONNECT_TIMEOUT = 5  # 外部请求连接超时（秒）
+HTTP_READ_TIMEOUT = 15  # 外部请求读取超时（秒）
+HTTP_HOST_CONCURRENCY = 10  # 每个上游主机的最大并发请求数
+HTTP_BREAKER_WINDOW = 20  # 熔断统计最近的请求数
+HTTP_BREAKER_MIN_REQUESTS = 5  # 至少有这么多次请求才会判断熔断
+HTTP_BREAKER_FAILURE_RATE = 0.5  # 失败率达到该值时熔断
+HTTP_BREAKER_COOLDOWN = 30  # 熔断后多久允许试探请求（秒）
+HTTP_MAX_CONNECTIONS = 100  # 外部请求连接池最大连接数
+HTTP_MAX_KEEPALIVE = 20  # 连接池保持的空闲连接数
+HTTP_KEEPALIVE_EXPIRY = 30  # 空闲连接保持时间（秒）
+HTTP_USE_HTTP2 = True  # 是否启用HTTP/2（需要安装h2，未安装时自动关闭）
+HTTP_CACHE_TTL = 300  # 外部请求缓存有效期（秒）
+HTTP_CACHE_STALE_TTL = 600  # 过期后仍可返回旧数据并后台刷新的时间（秒）
+HTTP_CACHE_MAX_ENTRIES = 1000  # 外部请求缓存最大条数
+HTTP_CACHE_MAX_BYTES = 32 * 1024 * 1024  # 外部请求缓存最大字节数
+HTTP_DISK_CACHE = False  # 是否将外部请求缓存持久化到 Van_keyword_data/http_cache
+HTTP_DISK_CACHE_MAX_BYTES = 128 * 1024 * 1024  # 磁盘缓存最大字节数
 
 print(f"\n{'='*50}")
 print(f"🔐 API Token: {API_TOKEN}")
@@ -27,6 +95,97 @@ print(f"🌍 WebUI地址: http://{API_HOST}:{API_PORT}/webui")
 print(f"📖 API文档: http://{API_HOST}:{API_PORT}/docs")
 print(f"{'='*50}\n")
 
+# ==================== 缓存 ====================
+class LRUCache:
+    """带容量、字节数限制和TTL的LRU缓存"""
+    def __init__(self, max_entries, max_bytes, ttl, stale_ttl=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._data = OrderedDict()  # key -> (过期时间, 失效时间, 字节数, 值)
+        self.size_bytes = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def __len__(self):
+        return len(self._data)
+    
+    def __contains__(self, key):
+        return key in self._data
+    
+    def get(self, key):
+        """获取缓存，返回 (值, 是否新鲜)；不存在或已彻底失效时返回None"""
+        entry = self._data.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        expire_at, stale_until, _, value = entry
+        now = time.time()
+        if now >= stale_until:
+            self.pop(key)
+            self.misses += 1
+            return None
+        
+        self._data.move_to_end(key)
+        if now < expire_at:
+            self.hits += 1
+            return value, True
+        self.stale_hits += 1
+        return value, False
+    
+    def set(self, key, value, ttl=None):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        ttl = self.ttl if ttl is None else ttl
+        if isinstance(value, str):
+            size = len(value.encode('utf-8'))
+        elif isinstance(value, (bytes, bytearray)):
+            size = len(value)
+        else:
+            size = sys.getsizeof(value)
+        
+        if size > self.max_bytes:
+            return
+        
+        self.pop(key)
+        now = time.time()
+        self._data[key] = (now + ttl, now + ttl + self.stale_ttl, size, value)
+        self.size_bytes += size
+        
+        while self._data and (len(self._data) > self.max_entries or self.size_bytes > self.max_bytes):
+            _, (_, _, old_size, _) = self._data.popitem(last=False)
+            self.size_bytes -= old_size
+            self.evictions += 1
+    
+    def pop(self, key):
+        """删除缓存条目"""
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.size_bytes -= entry[2]
+        return entry
+    
+    def clear(self):
+        self._data.clear()
+        self.size_bytes = 0
+    
+    def stats(self):
+        """缓存统计信息"""
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.size_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": None if math.isinf(self.max_bytes) else self.max_bytes,  # None为不限字节数
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0
+        }
+
 # ==================== 全局变量 ====================
 # 字典存储不同机器人的信息
 global_group_ids = {}  # 消息环境
@@ -35,7 +194,16 @@ data_files = {}  # 词库文件
 datas = {}  # 词库数据
 global_bot_ids = {}  # 机器人
 global_message_ids = {}  # 消息ID缓存
-global_cache = {}  # 全局缓存
+global_lexicon_versions = {}  # 当前加载的词库内容签名
+global_lexicon_files = {}  # 当前加载的词库文件及其修改时间和大小，未变化时不重新读取
+global_lexicon_indexes = {}  # 词库关键词索引（按机器人和词库文件）
+global_cache = LRUCache(HTTP_CACHE_MAX_ENTRIES, HTTP_CACHE_MAX_BYTES, HTTP_CACHE_TTL, HTTP_CACHE_STALE_TTL)  # 外部请求缓存
+global_inflight_requests = {}  # 正在进行的上游请求（按URL合并）
+global_host_guards = {}  # 每个上游主机的并发限制与熔断状态
+disk_cache = None  # 外部请求磁盘缓存
+global_decode_cache = LRUCache(DECODE_CACHE_SIZE, math.inf, math.inf)  # 静态回复解码缓存（只按条数淘汰，不过期）
+global_transcode_cache = LRUCache(TRANSCODE_CACHE_SIZE, math.inf, math.inf)  # CQ码转码缓存
+http_client = None  # 共享HTTP客户端
 
 # 冷却时间数据
 cooling_data = {}
@@ -51,10 +219,58 @@ else:
 print(f"📁 工作目录: {directory}")
 
 # ==================== 日志系统 ====================
-class Logger:
-    def __init__(self):
+LOG_LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40}
+
+def _log_level_no(level):
+    return LOG_LEVELS.get(str(level).upper(), LOG_LEVELS["INFO"])
+
+class LogMethods:
+    """按级别记录日志的快捷方法，message中的%s在级别启用时才用args格式化"""
+    
+    def enabled(self, level):
+        return _log_level_no(level) >= self.level
+    
+    def info(self, message: str, *args):
+        self.log("INFO", message, *args)
+    
+    def debug(self, message: str, *args):
+        self.log("DEBUG", message, *args)
+    
+    def error(self, message: str, *args):
+        self.log("ERROR", message, *args)
+    
+    def warn(self, message: str, *args):
+        self.log("WARN", message, *args)
+
+class LogChannel(LogMethods):
+    """子系统日志 - 使用独立的最低级别，写入同一个日志文件"""
+    
+    def __init__(self, root, name, level):
+        self.root = root
+        self.name = name
+        self.level = level
+    
+    def log(self, level: str, message: str, *args):
+        if self.enabled(level):
+            self.root.emit(level, message, args, self.name)
+
+class Logger(LogMethods):
+    """日志记录器 - 调用方只把日志放入队列，由后台线程批量写入文件和控制台"""
+    
+    def __init__(self, console=LOG_CONSOLE, level=LOG_LEVEL):
         self.log_file = os.path.join(directory, "api_log.txt")
+        self.console = console
+        self.level = _log_level_no(level)
+        self.file = None  # 保持打开的日志文件
+        self.file_size = 0
+        self.file_day = None  # 当前日志文件对应的日期，用于按天轮转
+        self.archive_lock = threading.Lock()  # 历史日志依次压缩和清理
         self.ensure_log_file()
+        
+        self.queue = queue.SimpleQueue()
+        self.writer = threading.Thread(target=self._writer_loop, name="log-writer", daemon=True)
+        self.writer.start()
+        atexit.register(self.close)
     
     def ensure_log_file(self):
         """确保日志文件存在"""
@@ -62,34 +278,390 @@ class Logger:
             with open(self.log_file, 'w', encoding='utf-8') as f:
                 f.write(f"VanBot API 日志文件 - 创建时间: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
     
-    def log(self, level: str, message: str):
+    def channel(self, name):
+        """获取子系统日志，未单独配置级别时使用全局级别"""
+        level = LOG_SUBSYSTEM_LEVELS.get(name)
+        return LogChannel(self, name, self.level if level is None else _log_level_no(level))
+    
+    def log(self, level: str, message: str, *args):
         """记录日志"""
+        if self.enabled(level):
+            self.emit(level, message, args)
+    
+    def emit(self, level, message, args=(), subsystem=None):
+        """格式化并放入写入队列"""
+        if args:
+            try:
+                message = message % args
+            except (TypeError, ValueError):
+                message = f"{message} {args}"
+        if LOG_FORMAT == "json":
+            record = {"ts": datetime.now().isoformat(timespec="milliseconds"), "level": level.upper(), "msg": message}
+            if subsystem:
+                record["subsystem"] = subsystem
+            trace = current_trace.get()
+            if trace is not None:
+                record.update(trace.fields())
+            self.queue.put(json_dumps(record))
+            return
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_message = f"[{timestamp}] [{level.upper()}] {message}"
-        
-        # 打印到控制台
-        print(log_message)
+        self.queue.put(f"[{timestamp}] [{level.upper()}] {message}")
+    
+    def request(self, trace):
+        """记录一次请求的汇总：状态、总耗时和各阶段耗时"""
+        duration = (time.perf_counter() - trace.start) * 1000
+        stages = {name: round(seconds * 1000, 3) for name, seconds in trace.stages.items()}
+        if LOG_FORMAT == "json":
+            if self.enabled("INFO"):
+                record = {"ts": datetime.now().isoformat(timespec="milliseconds"), "level": "INFO", "type": "request"}
+                record.update(trace.fields())
+                record.update(status=trace.status, duration_ms=round(duration, 3), stages=stages)
+                self.queue.put(json_dumps(record))
+        elif self.enabled("DEBUG"):
+            self.emit("DEBUG", "请求完成: id=%s, action=%s, 状态=%s, 耗时=%.1fms, 阶段=%s",
+                      (trace.request_id, trace.action, trace.status, duration, stages))
+    
+    def _writer_loop(self):
+        """后台写入线程：阻塞等待第一条日志，再取出队列中已有的日志一起写入"""
+        running = True
+        while running:
+            batch = [self.queue.get()]
+            while len(batch) < LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            
+            lines = []
+            waiters = []
+            for item in batch:
+                if item is None:
+                    running = False
+                elif isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    lines.append(item)
+            
+            try:
+                self._write(lines)
+            except Exception as e:
+                # 单批写入失败只丢弃这一批，写入线程继续运行
+                self._report(f"⚠️  写入日志失败: {e}")
+            for event in waiters:
+                event.set()
+        
+        if self.file:
+            self.file.close()
+            self.file = None
+    
+    def _write(self, lines):
+        if not lines:
+            return
+        text = "\n".join(lines) + "\n"
+        
+        # 打印到控制台（无控制台的打包程序中sys.stdout为None）
+        if self.console and sys.stdout is not None:
+            try:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            except Exception:
+                pass
         
         # 写入文件
         try:
-            with open(self.log_file, 'a', encoding='utf-8') as f:
-                f.write(log_message + "\n")
+            if self.file is None:
+                self._open()
+            if self._should_rotate():
+                self._rotate()
+            self.file.write(text)
+            self.file.flush()
+            self.file_size = self.file.tell()
         except Exception as e:
-            print(f"⚠️  写入日志失败: {e}")
+            self._report(f"⚠️  写入日志失败: {e}")
+            if self.file:
+                try:
+                    self.file.close()
+                except Exception:
+                    pass
+            self.file = None
+    
+    @staticmethod
+    def _report(message):
+        """日志系统自身的错误只尝试输出到控制台"""
+        if sys.stdout is None:
+            return
+        try:
+            print(message)
+        except Exception:
+            pass
     
-    def info(self, message: str):
-        self.log("INFO", message)
+    def _open(self):
+        self.ensure_log_file()
+        self.file = open(self.log_file, 'a', encoding='utf-8')
+        self.file_size = self.file.tell()
+        self.file_day = datetime.fromtimestamp(os.path.getmtime(self.log_file)).date()
+    
+    def _should_rotate(self):
+        if LOG_MAX_BYTES and self.file_size >= LOG_MAX_BYTES:
+            return True
+        return LOG_ROTATE_DAILY and self.file_day != datetime.now().date()
+    
+    def _rotate(self):
+        """把当前日志改名为带时间的历史文件，压缩和清理交给后台线程"""
+        self.file.close()
+        self.file = None
+        base, ext = os.path.splitext(self.log_file)
+        rotated = f"{base}.{datetime.now().strftime('%Y%m%d-%H%M%S')}{ext}"
+        suffix = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            rotated = f"{base}.{datetime.now().strftime('%Y%m%d-%H%M%S')}-{suffix}{ext}"
+            suffix += 1
+        os.replace(self.log_file, rotated)
+        self._open()
+        threading.Thread(target=self._archive, args=(rotated,), name="log-archive", daemon=True).start()
+    
+    def _archive(self, path):
+        """压缩轮转后的日志，并删除超出保留数量的历史日志"""
+        with self.archive_lock:
+            try:
+                if LOG_COMPRESS:
+                    with open(path, 'rb') as src, gzip.open(path + ".gz", 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                    os.remove(path)
+                
+                log_dir = os.path.dirname(self.log_file)
+                base, ext = os.path.splitext(os.path.basename(self.log_file))
+                history = sorted(
+                    name for name in os.listdir(log_dir)
+                    if name.startswith(base + ".") and (name.endswith(ext) or name.endswith(ext + ".gz"))
+                    and name != os.path.basename(self.log_file)
+                )
+                for name in history[:max(len(history) - LOG_BACKUP_COUNT, 0)]:
+                    os.remove(os.path.join(log_dir, name))
+            except Exception as e:
+                self._report(f"⚠️  归档日志失败: {e}")
     
-    def debug(self, message: str):
-        self.log("DEBUG", message)
+    def flush(self, timeout=5):
+        """等待队列中已有的日志写入完成"""
+        if self.writer.is_alive():
+            event = threading.Event()
+            self.queue.put(event)
+            event.wait(timeout)
     
-    def error(self, message: str):
-        self.log("ERROR", message)
+    def close(self):
+        """写完剩余日志并关闭文件"""
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join(timeout=5)
     
-    def warn(self, message: str):
-        self.log("WARN", message)
-
 logger = Logger()
+query_log = logger.channel("query")  # 词条匹配
+decode_log = logger.channel("decode")  # 转码与解码
+io_log = logger.channel("io")  # 文件读写与词库加载
+http_log = logger.channel("http")  # 外部请求
+
+# ==================== 监控指标 ====================
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _metric_labels(names, values):
+    if not names:
+        return ""
+    escaped = (
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for value in values
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(names, escaped)) + "}"
+
+class MetricCounter:
+    """按标签累加的计数器"""
+    
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.values = {}
+    
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_metric_labels(self.labels, label_values)} {value}")
+        return lines
+
+class MetricHistogram:
+    """按标签统计的直方图"""
+    
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self.values = {}  # 标签 -> [各桶计数, 总和, 次数]
+    
+    def observe(self, value, *label_values):
+        entry = self.values.get(label_values)
+        if entry is None:
+            entry = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        position = bisect.bisect_left(self.buckets, value)
+        if position < len(self.buckets):
+            entry[0][position] += 1
+        entry[1] += value
+        entry[2] += 1
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _metric_labels(self.labels + ("le",), label_values + (bound,))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _metric_labels(self.labels + ("le",), label_values + ("+Inf",))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _metric_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {round(total, 6)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+def _metric_gauge(name, help_text, samples, labels=()):
+    """输出当前值类型的指标，samples为 (标签值, 数值) 列表"""
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+    for label_values, value in samples:
+        lines.append(f"{name}{_metric_labels(labels, label_values)} {value}")
+    return lines
+
+class Metrics:
+    """服务运行指标，由 /metrics 以Prometheus文本格式输出"""
+    
+    def __init__(self):
+        self.requests = MetricCounter("van_requests_total", "按操作和状态码统计的请求数", ("action", "status"))
+        self.request_seconds = MetricHistogram("van_request_duration_seconds", "按操作统计的请求耗时", ("action",))
+        self.in_flight = 0
+        self.matches = MetricCounter("van_keyword_matches_total", "按词库层级和匹配方式统计的命中数", ("tier", "mode"))
+        self.misses = MetricCounter("van_keyword_misses_total", "未命中任何词条的查询数")
+        self.cache_lookups = MetricCounter("van_cache_lookups_total", "解码/转码缓存的查找次数", ("cache", "result"))
+        self.get_data_requests = MetricCounter("van_get_data_requests_total", "外部请求按缓存结果统计", ("result",))
+        self.get_data_fetches = MetricCounter("van_get_data_fetches_total", "上游请求按结果统计", ("result",))
+        self.get_data_seconds = MetricHistogram("van_get_data_upstream_seconds", "上游请求耗时")
+    
+    def render(self):
+        lines = []
+        lines += self.requests.render()
+        lines += self.request_seconds.render()
+        lines += _metric_gauge("van_requests_in_flight", "正在处理的请求数", [((), self.in_flight)])
+        lines += self.matches.render()
+        lines += self.misses.render()
+        lines += self.cache_lookups.render()
+        
+        # 缓存命中率：解码/转码缓存按查找次数计算，外部请求缓存使用LRUCache的统计
+        ratios = []
+        for cache in ("decode", "transcode"):
+            hits = self.cache_lookups.values.get((cache, "hit"), 0)
+            total = hits + self.cache_lookups.values.get((cache, "miss"), 0)
+            ratios.append(((cache,), round(hits / total, 4) if total else 0.0))
+        ratios.append((("http",), global_cache.stats()["hit_ratio"]))
+        lines += _metric_gauge("van_cache_hit_ratio", "缓存命中率", ratios, ("cache",))
+        
+        lexicons = lexicon_status()
+        lines += _metric_gauge(
+            "van_lexicon_keywords", "已加载词库的词条数",
+            [((item["bot_id"], item["file"]), item["keyword_count"]) for item in lexicons], ("bot_id", "file")
+        )
+        lines += _metric_gauge(
+            "van_lexicon_replies", "已加载词库的回复数",
+            [((item["bot_id"], item["file"]), item["reply_count"]) for item in lexicons], ("bot_id", "file")
+        )
+        
+        lines += self.get_data_requests.render()
+        lines += self.get_data_fetches.render()
+        lines += self.get_data_seconds.render()
+        lines += _metric_gauge("van_get_data_in_flight", "进行中的上游请求数", [((), len(global_inflight_requests))])
+        lines += _metric_gauge(
+            "van_http_breaker_open", "上游主机熔断状态（1为熔断中）",
+            [((host,), int(guard.state == "open")) for host, guard in sorted(global_host_guards.items())], ("host",)
+        )
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+# ==================== 请求追踪 ====================
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+class RequestTrace:
+    """一次请求的追踪信息：请求ID、操作、机器人/群和各阶段耗时，结束时写入日志"""
+    
+    def __init__(self, action="unknown", request_id=None, bot_id=None, group_id=None):
+        self.request_id = request_id or uuid.uuid4().hex[:16]
+        self.action = action
+        self.bot_id = bot_id
+        self.group_id = group_id
+        self.stages = {}  # 阶段名 -> 累计秒数
+        self.status = 200
+        self.start = time.perf_counter()
+        self._token = None
+    
+    @classmethod
+    def from_request(cls, req, request_id=None):
+        """从校验后的请求模型创建"""
+        return cls(request_id=request_id).bind(req)
+    
+    def bind(self, req):
+        """填入校验后的请求模型的操作、机器人和群，respond请求从事件中取机器人和群"""
+        event = getattr(req, "event", None) or {}
+        self.action = req.action
+        self.bot_id = getattr(req, "botid", 0) or event.get("self_id")
+        self.group_id = getattr(req, "groupid", None) or event.get("group_id")
+        return self
+    
+    def fields(self):
+        return {"request_id": self.request_id, "action": self.action, "bot_id": self.bot_id, "group_id": self.group_id}
+    
+    def __enter__(self):
+        self._token = current_trace.set(self)
+        metrics.in_flight += 1
+        return self
+    
+    def __exit__(self, exc_type, exc, tb):
+        current_trace.reset(self._token)
+        metrics.in_flight -= 1
+        if exc is not None:
+            self.status = exc.status_code if isinstance(exc, HTTPException) else 500
+        metrics.requests.inc(self.action, str(self.status))
+        metrics.request_seconds.observe(time.perf_counter() - self.start, self.action)
+        logger.request(self)
+        return False
+
+@contextmanager
+def trace_stage(name):
+    """把代码块的耗时计入当前请求的某个阶段"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.stages[name] = trace.stages.get(name, 0) + time.perf_counter() - start
+
+def traced(stage):
+    """装饰器：函数的耗时计入当前请求的某个阶段"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with trace_stage(stage):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace_stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
 
 # ==================== 辅助函数 ====================
 def ensure_dir(path):
@@ -115,6 +687,56 @@ def get_data_dir():
     data_dir = ensure_dir(data_dir)
     return data_dir
 
+# ==================== JSON序列化 ====================
+def _select_json_backend():
+    """按配置选择可用的JSON库"""
+    if JSON_BACKEND in ("auto", "orjson") and orjson is not None:
+        return "orjson"
+    if JSON_BACKEND in ("auto", "msgspec") and msgspec is not None:
+        return "msgspec"
+    return "json"
+
+json_backend = _select_json_backend()
+
+def json_dumps_bytes(data, indent=None):
+    """序列化为UTF-8字节，indent为空时输出紧凑格式"""
+    try:
+        if json_backend == "orjson":
+            # orjson只支持2空格缩进
+            option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+            return orjson.dumps(data, option=option)
+        if json_backend == "msgspec":
+            encoded = msgspec.json.encode(data)
+            return msgspec.json.format(encoded, indent=indent) if indent else encoded
+    except (TypeError, ValueError, OverflowError):
+        pass  # 超出范围的整数等情况交给标准库处理
+    separators = None if indent else (',', ':')
+    return json.dumps(data, indent=indent or None, ensure_ascii=False, separators=separators).encode('utf-8')
+
+def json_dumps(data, indent=None):
+    """序列化为字符串"""
+    return json_dumps_bytes(data, indent).decode('utf-8')
+
+def json_loads(text):
+    """反序列化JSON字符串或字节"""
+    if json_backend == "orjson":
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    elif json_backend == "msgspec":
+        try:
+            return msgspec.json.decode(text)
+        except msgspec.DecodeError:
+            pass
+    return json.loads(text)
+
+def dump_lexicon(data):
+    """序列化词库数据用于保存，有缩进时使用标准库json，保持原有的词库文件格式（orjson只支持2空格缩进）"""
+    if LEXICON_JSON_INDENT:
+        return json.dumps(data, indent=LEXICON_JSON_INDENT, ensure_ascii=False)
+    return json_dumps(data)
+
 # ==================== 文件操作 ====================
 async def file_control(bot_id, filename, mode, content=None):
     """文件操作函数"""
@@ -137,10 +759,10 @@ async def file_control(bot_id, filename, mode, content=None):
             if os.path.exists(file_path):
                 with open(file_path, 'r', encoding='utf-8') as f:
                     result = f.read()
-                    logger.debug(f"读取文件: {file_path}, 大小: {len(result)} 字节")
+                    io_log.debug("读取文件: %s, 大小: %s 字节", file_path, len(result))
                     return result
             else:
-                logger.debug(f"文件不存在: {file_path}")
+                io_log.debug("文件不存在: %s", file_path)
                 # 文件不存在时返回默认值
                 if filename == "switch.txt" or filename.startswith("cooling") or filename == "select.txt":
                     return "official_group=1019070322"
@@ -153,12 +775,23 @@ async def file_control(bot_id, filename, mode, content=None):
         elif mode == 'w':
             with open(file_path, 'w', encoding='utf-8') as f:
                 f.write(content)
-            logger.info(f"写入文件: {file_path}, 大小: {len(content)} 字节")
+            io_log.info("写入文件: %s, 大小: %s 字节", file_path, len(content))
+            if filename == data_files.get(bot_id):
+                # 内存中的词库就是刚写入的内容，记录新的文件签名以免下次重新加载
+                global_lexicon_files[bot_id] = (filename, _file_signature(file_path))
             return "写入成功"
     except Exception as e:
-        logger.error(f"文件操作失败：{str(e)}")
+        io_log.error("文件操作失败：%s", str(e))
         return None
 
+def _file_signature(file_path):
+    """文件的修改时间和大小，文件不存在时返回None"""
+    try:
+        stat = os.stat(file_path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
 # ==================== 核心函数 ====================
 def refresh_admin(user=None, op=None):
     """刷新管理员列表"""
@@ -177,7 +810,7 @@ def refresh_admin(user=None, op=None):
                     ADMIN_IDS = lines[0].split(",")
                 else:
                     ADMIN_IDS = lines.copy()
-            logger.debug(f"加载管理员列表: {ADMIN_IDS}")
+            io_log.debug("加载管理员列表: %s", ADMIN_IDS)
         except Exception as e:
             logger.error(f"读取管理员文件失败: {e}")
             ADMIN_IDS = []
@@ -202,6 +835,7 @@ def refresh_admin(user=None, op=None):
 
 ADMIN_IDS = refresh_admin()
 
+@traced("context_load")
 async def _global_file(bot_id, user_id, group_id=None, data_file=None):
     """初始化全局信息"""
     global_user_ids[bot_id] = user_id
@@ -218,21 +852,33 @@ async def _global_file(bot_id, user_id, group_id=None, data_file=None):
         global_group_ids[bot_id] = data_file
         data_files[bot_id] = f"lexicon/{global_group_ids[bot_id]}.json"
     
-    logger.debug(f"_global_file: bot_id={bot_id}, user_id={user_id}, data_file={data_file}")
+    io_log.debug("_global_file: bot_id=%s, user_id=%s, data_file=%s", bot_id, user_id, data_file)
+    
+    # 词库文件未变化时直接使用已加载的数据
+    file_path = os.path.join(get_data_dir(), str(bot_id), data_files[bot_id])
+    signature = _file_signature(file_path)
+    loaded = global_lexicon_files.get(bot_id)
+    if signature is not None and bot_id in datas and loaded == (data_files[bot_id], signature):
+        io_log.debug("词库文件未变化，跳过加载: bot_id=%s, 文件=%s", bot_id, data_files[bot_id])
+        return True
     
     # 加载词库数据
     data_content = await file_control(bot_id, data_files[bot_id], "r")
+    global_lexicon_versions[bot_id] = hash(data_content)
+    global_lexicon_files[bot_id] = (data_files[bot_id], signature)
     if data_content:
         try:
-            datas[bot_id] = json.loads(data_content)
-            logger.info(f"加载词库数据成功: bot_id={bot_id}, 词条数={len(datas[bot_id].get('work', []))}")
+            datas[bot_id] = json_loads(data_content)
+            io_log.info("加载词库数据成功: bot_id=%s, 词条数=%s", bot_id, len(datas[bot_id].get('work', [])))
         except Exception as e:
-            logger.error(f"解析词库JSON失败: {e}")
+            io_log.error("解析词库JSON失败: %s", e)
             datas[bot_id] = {"work": []}
     else:
-        logger.debug(f"无词库数据，创建空词库: bot_id={bot_id}")
+        io_log.debug("无词库数据，创建空词库: bot_id=%s", bot_id)
         datas[bot_id] = {"work": []}
     
+    # 加载时就建立词条/回复计数，只有查询流量的机器人也会出现在/status和/metrics中
+    get_lexicon_index(bot_id)
     return True
 
 async def get_select_file(bot_id):
@@ -354,9 +1000,154 @@ async def get_cooling(bot_id, lexicon_id=None):
         logger.error(f"冷却检查错误: {e}")
         return False
 
+# ==================== 词库索引 ====================
+class LexiconIndex:
+    """词库的词条/回复计数，以及search用的关键词字符n-gram倒排索引
+    
+    计数在创建时统计并随增删维护；倒排索引较重，第一次search时才建立，
+    只用count和[词汇量]的词库不会建立。
+    """
+    
+    GRAM_SIZES = (1, 2, 3)
+    
+    def __init__(self, work, version=None):
+        self.version = version  # 对应的词库内容签名，不一致时重建
+        self.grams = None  # n-gram -> 包含它的关键词集合，首次search时建立
+        self.key_counts = None  # 关键词 -> 出现次数，与grams一同建立
+        self.positions = None  # 关键词 -> 词条ID列表，删除后延迟重建
+        self.keyword_count = len(work)  # 词条数
+        self.reply_count = sum(len(value.get("r", [])) for item in work for value in item.values())  # 回复总数
+    
+    def _build_grams(self, work):
+        self.grams = {}
+        self.key_counts = {}
+        for item in work:
+            for key in item:
+                self.add_key(key)
+    
+    @classmethod
+    def _grams(cls, text):
+        return {text[i:i + n] for n in cls.GRAM_SIZES for i in range(len(text) - n + 1)}
+    
+    def add_entry(self, item, idx=None):
+        """索引一个词条，idx为其词条ID"""
+        self.keyword_count += 1
+        for key, value in item.items():
+            self.reply_count += len(value.get("r", []))
+            self.add_key(key, idx)
+    
+    def remove_entry(self, item):
+        """移除一个词条"""
+        self.keyword_count -= 1
+        for key, value in item.items():
+            self.reply_count -= len(value.get("r", []))
+            self.remove_key(key)
+    
+    def add_key(self, key, idx=None):
+        """索引一个关键词，idx为其词条ID"""
+        if self.grams is None:
+            return
+        count = self.key_counts.get(key, 0)
+        self.key_counts[key] = count + 1
+        if not count:
+            for gram in self._grams(key):
+                self.grams.setdefault(gram, set()).add(key)
+        if self.positions is not None:
+            if idx is None:
+                self.positions = None
+            else:
+                self.positions.setdefault(key, []).append(idx)
+    
+    def remove_key(self, key):
+        """移除一个关键词，词条ID随之改变"""
+        self.positions = None
+        if self.grams is None:
+            return
+        count = self.key_counts.get(key, 0)
+        if count > 1:
+            self.key_counts[key] = count - 1
+            return
+        self.key_counts.pop(key, None)
+        for gram in self._grams(key):
+            keys = self.grams.get(gram)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.grams[gram]
+    
+    def _get_positions(self, work):
+        if self.positions is None:
+            positions = {}
+            for idx, item in enumerate(work, 1):
+                for key in item:
+                    positions.setdefault(key, []).append(idx)
+            self.positions = positions
+        return self.positions
+    
+    def search(self, work, keyword):
+        """返回包含keyword的 (词条ID, 关键词) 列表，按词条ID排序"""
+        if self.grams is None:
+            self._build_grams(work)
+            query_log.debug("建立词库关键词索引: 关键词数=%s", len(self.key_counts))
+        size = min(len(keyword), self.GRAM_SIZES[-1])
+        postings = sorted(
+            (self.grams.get(keyword[i:i + size], ()) for i in range(len(keyword) - size + 1)),
+            key=len
+        )
+        # 从最小的候选集开始求交集，再逐个验证
+        candidates = set(postings[0])
+        for keys in postings[1:]:
+            if not candidates:
+                break
+            candidates &= keys
+        
+        positions = self._get_positions(work)
+        return sorted(
+            (idx, key)
+            for key in candidates if keyword in key
+            for idx in positions.get(key, ())
+        )
+
+def get_lexicon_index(bot_id):
+    """获取当前词库的索引，词库内容变化后重建"""
+    index_key = (bot_id, data_files.get(bot_id))
+    version = global_lexicon_versions.get(bot_id)
+    index = global_lexicon_indexes.get(index_key)
+    if index is None or index.version != version:
+        work = datas.get(bot_id, {"work": []})["work"]
+        index = LexiconIndex(work, version)
+        global_lexicon_indexes[index_key] = index
+        query_log.debug("重建词库计数: bot_id=%s, 词条数=%s", bot_id, index.keyword_count)
+    return index
+
+def lexicon_status():
+    """已加载词库的词条与回复计数"""
+    return [
+        {
+            "bot_id": bot_id,
+            "file": data_file,
+            "keyword_count": index.keyword_count,
+            "reply_count": index.reply_count
+        }
+        for (bot_id, data_file), index in global_lexicon_indexes.items()
+    ]
+
+@traced("persist")
+def _commit_lexicon(bot_id, index):
+    """序列化词库，并把索引标记为与写入的内容一致"""
+    content = dump_lexicon(datas[bot_id])
+    # 内存已修改，写入成功前不能再当作与文件一致
+    global_lexicon_files.pop(bot_id, None)
+    index.version = global_lexicon_versions[bot_id] = hash(content)
+    return content
+
 # ==================== 词库操作函数 ====================
 async def lexicon_operation(bot_id, op_type, **kwargs):
-    """词库操作函数"""
+    """词库操作函数
+    
+    get返回 (回复, 词条ID, 来源词库)，未命中时为 ("", 0, None)。
+    主词库的词条ID为序号，其他词库为"词库名:序号"，避免冷却记录和[词条id]与主词库冲突。
+    """
     def clean_special_chars(text):
         if MISTAKE_TURN_TYPE:
             return text.replace('【', '[').replace('】', ']')\
@@ -377,7 +1168,7 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
     
     valid_ops = {"get", "add", "remove", "add_r", "remove_r"}
     if op_type not in valid_ops:
-        logger.error(f"无效操作类型: {op_type}")
+        query_log.error("无效操作类型: %s", op_type)
         return f"无效操作类型！支持：{list(valid_ops)}"
     
     # 确保datas存在
@@ -388,35 +1179,41 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
     if op_type == "get":
         value = kwargs.get("value", "")
         if not value:
-            logger.debug(f"查询值为空: bot_id={bot_id}")
-            return ""
+            query_log.debug("查询值为空: bot_id=%s", bot_id)
+            return "", 0, None
         
-        logger.info(f"开始查询词条: bot_id={bot_id}, value='{value}'")
+        query_log.info("开始查询词条: bot_id=%s, value='%s'", bot_id, value)
         
         # 检查是否是特殊恢复指令
         if value == "HUANYUAN":
-            return ""
+            return "", 0, None
         
         group_user = await get_user_file(bot_id)
         if not group_user:
             group_user = global_group_ids.get(bot_id, "")
         
-        logger.debug(f"group_user: {group_user}")
+        query_log.debug("group_user: %s", group_user)
+        
+        # 逐词条的调试日志只在启用DEBUG时记录
+        query_debug = query_log.enabled("DEBUG")
         
         # 首先检查主词库（datas）
-        for item in datas[bot_id]["work"]:
+        primary = os.path.splitext(os.path.basename(data_files.get(bot_id, "")))[0]
+        for idx, item in enumerate(datas[bot_id]["work"], 1):
             for key, val in item.items():
-                logger.debug(f"检查词条: '{key}' (模式: {val.get('s', 0)}), 回复数: {len(val.get('r', []))}")
+                if query_debug:
+                    query_log.debug("检查词条: '%s' (模式: %s), 回复数: %s", key, val.get('s', 0), len(val.get('r', [])))
                 
                 # 检查权限
                 if val.get('s') == 10 and str(global_user_ids.get(bot_id, "")) not in ADMIN_IDS:
-                    logger.debug(f"跳过权限限制词条: {key}")
+                    if query_debug:
+                        query_log.debug("跳过权限限制词条: %s", key)
                     continue
                 
                 # 检查变量匹配 [n.?]
                 tool_n = await get_n(key, value)
                 if tool_n:
-                    logger.info(f"变量匹配成功: {key}")
+                    query_log.info("变量匹配成功: %s", key)
                     if val.get('r'):
                         text_n = random.choice(val['r'])
                         tool_n[0] = text_n
@@ -426,41 +1223,46 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
                             if mapping:
                                 tool_n[0] = replace_variable(text_n, mapping)
                         
-                        return tool_n
+                        metrics.matches.inc("primary", "template")
+                        return tool_n, idx, primary
                 
                 # 精确匹配
                 if key == value and val.get('s') == 1:
-                    logger.info(f"精确匹配成功: '{key}'")
+                    query_log.info("精确匹配成功: '%s'", key)
                     if val.get('r'):
                         result = random.choice(val['r'])
-                        logger.info(f"返回回复: '{result}'")
+                        query_log.info("返回回复: '%s'", result)
                         if str(group_user).startswith('E'):
                             mapping = await file_control(bot_id, f"expand/{group_user}.json", "r")
                             if mapping:
                                 result = replace_variable(result, mapping)
-                        return result
+                        metrics.matches.inc("primary", "exact")
+                        return result, idx, primary
                 
                 # 模糊匹配
                 if key in value and val.get('s') == 0:
-                    logger.info(f"模糊匹配成功: '{key}' in '{value}'")
+                    query_log.info("模糊匹配成功: '%s' in '%s'", key, value)
                     if val.get('r'):
                         result = random.choice(val['r'])
-                        logger.info(f"返回回复: '{result}'")
+                        query_log.info("返回回复: '%s'", result)
                         if str(group_user).startswith('E'):
                             mapping = await file_control(bot_id, f"expand/{group_user}.json", "r")
                             if mapping:
                                 result = replace_variable(result, mapping)
-                        return result
+                        metrics.matches.inc("primary", "fuzzy")
+                        return result, idx, primary
         
-        # 如果没有找到，尝试加载其他词库文件
-        data_id = [str(global_group_ids.get(bot_id, "")), str(group_user), "common"]
-        logger.debug(f"搜索数据源: {data_id}")
+        # 如果没有找到，依次尝试群词库、切换词库和公共词库，层级取自实际匹配的文件
+        data_id = [("group", str(global_group_ids.get(bot_id, ""))), ("switch", str(group_user)), ("common", "common")]
+        query_log.debug("搜索数据源: %s", data_id)
         
-        for id in data_id:
-            if not id or id == str(global_group_ids.get(bot_id, "")):
+        checked = {primary}
+        for tier, id in data_id:
+            if not id or id in checked:
                 continue  # 已经检查过了
+            checked.add(id)
                 
-            logger.debug(f"尝试加载词库: {id}")
+            query_log.debug("尝试加载词库: %s", id)
             data_path = f"lexicon/{id}.json"
             data_content = await file_control(bot_id, data_path, "r")
             
@@ -468,14 +1270,15 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
                 continue
                 
             try:
-                data = json.loads(data_content)
+                data = json_loads(data_content)
             except Exception as e:
-                logger.error(f"解析词库文件失败 {data_path}: {e}")
+                query_log.error("解析词库文件失败 %s: %s", data_path, e)
                 continue
             
-            for item in data.get('work', []):
+            for idx, item in enumerate(data.get('work', []), 1):
                 for key, val in item.items():
-                    logger.debug(f"检查词库 {id} 的词条: '{key}' (模式: {val.get('s', 0)})")
+                    if query_debug:
+                        query_log.debug("检查词库 %s 的词条: '%s' (模式: %s)", id, key, val.get('s', 0))
                     
                     # 检查权限
                     if val.get('s') == 10 and str(global_user_ids.get(bot_id, "")) not in ADMIN_IDS:
@@ -484,7 +1287,7 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
                     # 检查变量匹配 [n.?]
                     tool_n = await get_n(key, value)
                     if tool_n:
-                        logger.info(f"变量匹配成功 (来自 {id}): {key}")
+                        query_log.info("变量匹配成功 (来自 %s): %s", id, key)
                         if val.get('r'):
                             text_n = random.choice(val['r'])
                             tool_n[0] = text_n
@@ -494,32 +1297,36 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
                                 if mapping:
                                     tool_n[0] = replace_variable(text_n, mapping)
                             
-                            return tool_n
+                            metrics.matches.inc(tier, "template")
+                            return tool_n, f"{id}:{idx}", id
                     
                     # 精确匹配
                     if key == value and val.get('s') == 1:
-                        logger.info(f"精确匹配成功 (来自 {id}): '{key}'")
+                        query_log.info("精确匹配成功 (来自 %s): '%s'", id, key)
                         if val.get('r'):
                             result = random.choice(val['r'])
                             if str(group_user).startswith('E'):
                                 mapping = await file_control(bot_id, f"expand/{group_user}.json", "r")
                                 if mapping:
                                     result = replace_variable(result, mapping)
-                            return result
+                            metrics.matches.inc(tier, "exact")
+                            return result, f"{id}:{idx}", id
                     
                     # 模糊匹配
                     if key in value and val.get('s') == 0:
-                        logger.info(f"模糊匹配成功 (来自 {id}): '{key}' in '{value}'")
+                        query_log.info("模糊匹配成功 (来自 %s): '%s' in '%s'", id, key, value)
                         if val.get('r'):
                             result = random.choice(val['r'])
                             if str(group_user).startswith('E'):
                                 mapping = await file_control(bot_id, f"expand/{group_user}.json", "r")
                                 if mapping:
                                     result = replace_variable(result, mapping)
-                            return result
+                            metrics.matches.inc(tier, "fuzzy")
+                            return result, f"{id}:{idx}", id
         
-        logger.info(f"未找到匹配的词条: '{value}'")
-        return ""
+        query_log.info("未找到匹配的词条: '%s'", value)
+        metrics.misses.inc()
+        return "", 0, None
     
     # 添加词条
     elif op_type == "add":
@@ -541,11 +1348,13 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
                 return False  # 词条已存在
         
         # 添加新词条
+        index = get_lexicon_index(bot_id)
         new_item = {n: {"r": [r], "s": s}}
         datas[bot_id]["work"].append(new_item)
+        index.add_entry(new_item, len(datas[bot_id]["work"]))
         logger.info(f"添加词条成功: '{n}' -> '{r}', 模式: {s}")
         
-        return json.dumps(datas[bot_id], indent=4, ensure_ascii=False)
+        return _commit_lexicon(bot_id, index)
     
     # 删除词条
     elif op_type == "remove":
@@ -554,8 +1363,14 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
             logger.error("删除词条缺少参数")
             return "缺少参数"
         
+        index = get_lexicon_index(bot_id)
         original_count = len(datas[bot_id]["work"])
-        new_work = [item for item in datas[bot_id]["work"] if list(item.keys())[0] != key_to_delete]
+        new_work = []
+        for item in datas[bot_id]["work"]:
+            if list(item.keys())[0] != key_to_delete:
+                new_work.append(item)
+            else:
+                index.remove_entry(item)
         datas[bot_id]["work"] = new_work
         
         deleted_count = original_count - len(new_work)
@@ -564,7 +1379,7 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
         else:
             logger.info(f"未找到要删除的词条: '{key_to_delete}'")
         
-        return json.dumps(datas[bot_id], indent=4, ensure_ascii=False)
+        return _commit_lexicon(bot_id, index)
     
     # 添加回复选项
     elif op_type == "add_r":
@@ -577,6 +1392,7 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
         
         value = clean_special_chars(value)
         updated = False
+        index = get_lexicon_index(bot_id)
         
         for item in datas[bot_id]["work"]:
             if name in item:
@@ -584,6 +1400,7 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
                     item[name]['r'] = []
                 original_count = len(item[name]['r'])
                 item[name]['r'].append(value)
+                index.reply_count += 1
                 updated = True
                 logger.info(f"添加回复成功: '{name}' -> '{value}', 原回复数: {original_count}, 现回复数: {len(item[name]['r'])}")
                 break
@@ -592,7 +1409,7 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
             logger.info(f"添加回复失败，词条不存在: '{name}'")
             return False
         
-        return json.dumps(datas[bot_id], indent=4, ensure_ascii=False)
+        return _commit_lexicon(bot_id, index)
     
     # 删除回复选项
     elif op_type == "remove_r":
@@ -604,10 +1421,12 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
             return "缺少参数"
         
         updated = False
+        index = get_lexicon_index(bot_id)
         for item in datas[bot_id]["work"]:
             if name in item and 'r' in item[name] and value in item[name]['r']:
                 original_count = len(item[name]['r'])
                 item[name]['r'].remove(value)
+                index.reply_count -= 1
                 updated = True
                 logger.info(f"删除回复成功: '{name}' -> '{value}', 原回复数: {original_count}, 现回复数: {len(item[name]['r'])}")
                 break
@@ -616,50 +1435,301 @@ async def lexicon_operation(bot_id, op_type, **kwargs):
             logger.info(f"删除回复失败，词条或回复不存在: '{name}' -> '{value}'")
             return False
         
-        return json.dumps(datas[bot_id], indent=4, ensure_ascii=False)
+        return _commit_lexicon(bot_id, index)
+
+# ==================== 词库导入导出 ====================
+LEXICON_MODES = (0, 1, 10)  # 模糊、精确、管理员
+EXPORT_FORMATS = {
+    "json": ("application/json", "json"),
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv; charset=utf-8", "csv")
+}
+
+def _import_entry(raw):
+    """校验一条导入数据，返回 (关键词, 模式, 回复列表)"""
+    if not isinstance(raw, dict):
+        raise ValueError("词条必须是JSON对象")
+    keyword = raw.get("keyword")
+    replies = raw.get("replies")
+    if replies is None and raw.get("reply") is not None:
+        replies = [raw["reply"]]
+    mode = raw.get("mode", 1)
+    if not isinstance(keyword, str) or not keyword:
+        raise ValueError("缺少keyword")
+    # 回复列表可以为空（删除全部回复后的词条），导出的内容因此可以原样导入
+    if not isinstance(replies, list) or not all(isinstance(r, str) and r for r in replies):
+        raise ValueError(f"词条 '{keyword}' 的回复必须是非空字符串组成的列表")
+    if isinstance(mode, str) and mode.isdigit():
+        mode = int(mode)
+    if isinstance(mode, bool) or mode not in LEXICON_MODES:
+        raise ValueError(f"词条 '{keyword}' 的模式无效: {mode}")
+    return keyword, mode, replies
+
+def parse_import_entries(content, fmt):
+    """解析导入内容，返回 (词条列表, 错误列表)"""
+    entries = []
+    errors = []
+    
+    def add(position, raw):
+        try:
+            entries.append(_import_entry(raw))
+        except ValueError as e:
+            errors.append(f"{position}: {e}")
+    
+    if fmt == "json":
+        try:
+            data = json_loads(content)
+        except Exception as e:
+            return [], [f"JSON解析失败: {e}"]
+        if isinstance(data, dict) and isinstance(data.get("work"), list):
+            # 词库文件格式 {"work": [{关键词: {"r": [...], "s": 模式}}]}
+            for idx, item in enumerate(data["work"], 1):
+                if not isinstance(item, dict):
+                    errors.append(f"第 {idx} 项: 词条必须是JSON对象")
+                    continue
+                for key, value in item.items():
+                    value = value if isinstance(value, dict) else {}
+                    add(f"第 {idx} 项", {"keyword": key, "replies": value.get("r", []), "mode": value.get("s", 0)})
+        elif isinstance(data, list):
+            for idx, raw in enumerate(data, 1):
+                add(f"第 {idx} 项", raw)
+        else:
+            errors.append("JSON必须是词库文件格式或词条数组")
+    elif fmt == "ndjson":
+        for line_no, line in enumerate(content.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                raw = json_loads(line)
+            except Exception as e:
+                errors.append(f"第 {line_no} 行: JSON解析失败: {e}")
+                continue
+            add(f"第 {line_no} 行", raw)
+    elif fmt == "csv":
+        # 每行一个回复，同一关键词的多行合并为一个词条，reply为空的行表示没有回复的词条
+        reader = csv.DictReader(io.StringIO(content))
+        if not reader.fieldnames or not {"keyword", "reply"} <= set(reader.fieldnames):
+            return [], ["CSV缺少keyword或reply列"]
+        grouped = {}
+        for row in reader:
+            position = f"第 {reader.line_num} 行"
+            keyword = row.get("keyword") or ""
+            entry = grouped.get(keyword)
+            if entry is None:
+                entry = grouped[keyword] = {"keyword": keyword, "mode": row.get("mode") or 1, "replies": [], "position": position}
+            if row.get("reply"):
+                entry["replies"].append(row["reply"])
+        for entry in grouped.values():
+            add(entry.pop("position"), entry)
+    else:
+        errors.append(f"不支持的格式: {fmt}")
+    
+    return entries, errors
+
+def import_lexicon(bot_id, entries, replace=False):
+    """批量导入词条，一次完成合并和索引，返回 (序列化后的词库, 新增词条数, 新增回复数)"""
+    if bot_id not in datas:
+        datas[bot_id] = {"work": []}
+    
+    if replace:
+        datas[bot_id]["work"] = []
+        index = LexiconIndex([])
+        global_lexicon_indexes[(bot_id, data_files.get(bot_id))] = index
+    else:
+        index = get_lexicon_index(bot_id)
+    
+    work = datas[bot_id]["work"]
+    existing = {}
+    for item in work:
+        for key, value in item.items():
+            existing.setdefault(key, value)
+    
+    added_keywords = 0
+    added_replies = 0
+    for keyword, mode, replies in entries:
+        value = existing.get(keyword)
+        if value is None:
+            # 新词条，重复的回复只保留一个
+            new_item = {keyword: {"r": list(dict.fromkeys(replies)), "s": mode}}
+            work.append(new_item)
+            index.add_entry(new_item, len(work))
+            existing[keyword] = new_item[keyword]
+            added_keywords += 1
+            added_replies += len(new_item[keyword]["r"])
+        else:
+            # 已有词条，追加不存在的回复
+            current = value.setdefault("r", [])
+            known = set(current)
+            for reply in replies:
+                if reply not in known:
+                    current.append(reply)
+                    known.add(reply)
+                    index.reply_count += 1
+                    added_replies += 1
+    
+    logger.info(f"导入词条: bot_id={bot_id}, 新增词条={added_keywords}, 新增回复={added_replies}, 替换={replace}")
+    return _commit_lexicon(bot_id, index), added_keywords, added_replies
+
+async def export_lexicon_chunks(work, fmt, chunk_size=256):
+    """按块生成导出内容，内存占用只与块大小有关"""
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator="\n")
+        writer.writerow(["keyword", "mode", "reply"])
+        for idx, item in enumerate(work, 1):
+            for key, value in item.items():
+                for reply in value.get("r", []):
+                    writer.writerow([key, value.get("s", 0), reply])
+                if not value.get("r"):
+                    writer.writerow([key, value.get("s", 0), ""])
+            if idx % chunk_size == 0:
+                yield buffer.getvalue().encode("utf-8")
+                buffer.seek(0)
+                buffer.truncate()
+                await asyncio.sleep(0)
+        yield buffer.getvalue().encode("utf-8")
+        return
+    
+    if fmt == "json":
+        # 词库文件格式，逐个词条拼接数组
+        yield b'{"work":['
+        separator = b""
+        for start in range(0, len(work), chunk_size):
+            chunk = [json_dumps_bytes(item) for item in work[start:start + chunk_size]]
+            yield separator + b",".join(chunk)
+            separator = b","
+            await asyncio.sleep(0)
+        yield b"]}"
+        return
+    
+    for start in range(0, len(work), chunk_size):
+        chunk = [
+            json_dumps_bytes(entry)
+            for idx, item in enumerate(work[start:start + chunk_size], start + 1)
+            for entry in _list_entries(idx, item)
+        ]
+        yield b"\n".join(chunk) + b"\n"
+        await asyncio.sleep(0)
 
 # ==================== 消息转码和反编码 ====================
+# CQ码类型 -> 保留的参数
+_CQ_KEEP_PARAMS = {
+    'reply': 'id',
+    'at': 'qq',
+    'face': 'id',
+    'image': 'url',
+    'video': 'url',
+    'record': 'url',
+    'forward': 'id',
+    'file': 'file_id',
+    'json': 'data'
+}
+_CQ_CODE_PATTERN = re.compile(r'\[CQ:(\w+),(.*?)\]')
+_CQ_PARAM_PATTERNS = {
+    cq_type: re.compile(r'(?:^|,)' + key + r'=([^,]+)')
+    for cq_type, key in _CQ_KEEP_PARAMS.items()
+}
+
+def _replace_cq_code(match):
+    """将单个CQ码替换为[type.value]"""
+    cq_type = match.group(1)
+    param_pattern = _CQ_PARAM_PATTERNS.get(cq_type)
+    if param_pattern:
+        param = param_pattern.search(match.group(2))
+        if param:
+            return f'[{cq_type}.{param.group(1)}]'
+    return match.group(0)
+
+@traced("transcode")
 def _transcoding(text):
     """消息转码 - 将CQ码转换为内部格式"""
-    # CQ码转换
-    def parse_cq_code(cq_str, keep_params=None):
-        default_keep = {
-            'reply': 'id',
-            'at': 'qq',
-            'face': 'id',
-            'image': 'url',
-            'video': 'url',
-            'record': 'url',
-            'forward': 'id',
-            'file': 'file_id',
-            'json': 'data'
-        }
-        if keep_params is None:
-            keep_params = default_keep
-        
-        cq_str = str(cq_str)
-        pattern = r'\[CQ:(\w+),(.*?)\]'
-        
-        def replace_func(match):
-            cq_type = match.group(1)
-            params = dict(re.findall(r'(\w+)=([^,]+)', match.group(2)))
-            if cq_type in keep_params:
-                target_key = keep_params[cq_type]
-                if target_key in params:
-                    return f'[{cq_type}.{params[target_key]}]'
-            return match.group(0)
-        
-        if re.search(pattern, cq_str):
-            result = re.sub(pattern, replace_func, cq_str)
+    text = str(text)
+    
+    # 纯文本无需任何正则处理
+    if '[CQ:' not in text and '&' not in text:
+        return text
+    
+    cached = global_transcode_cache.get(text)
+    if cached is not None:
+        metrics.cache_lookups.inc("transcode", "hit")
+        return cached[0]
+    metrics.cache_lookups.inc("transcode", "miss")
+    
+    result = _CQ_CODE_PATTERN.sub(_replace_cq_code, text) if '[CQ:' in text else text
+    result = result.replace('&#91;', '[').replace('&#93;', ']').replace('&amp;', '&')
+    
+    if TRANSCODE_CACHE_SIZE > 0:
+        global_transcode_cache.set(text, result)
+    
+    return result
+
+@traced("transcode")
+def _segments_to_text(segments):
+    """消息转码 - 将OneBot消息段数组直接转换为内部格式"""
+    parts = []
+    for segment in segments:
+        if not isinstance(segment, dict):
+            continue
+        seg_type = str(segment.get("type", ""))
+        data = segment.get("data") or {}
+        
+        if seg_type == "text":
+            parts.append(str(data.get("text", "")))
+            continue
+        
+        target_key = _CQ_KEEP_PARAMS.get(seg_type)
+        if target_key and data.get(target_key) not in (None, ""):
+            parts.append(f"[{seg_type}.{data[target_key]}]")
         else:
-            result = cq_str
-        
-        result = result.replace('&#91;', '[').replace('&#93;', ']').replace('&amp;', '&')
-        return result
+            # 未知类型保持CQ码原样，与字符串转码结果一致（无参数时为[CQ:type]）
+            params = "".join(f",{k}={v}" for k, v in data.items())
+            parts.append(f"[CQ:{seg_type}{params}]")
     
-    return parse_cq_code(text, keep_params=None)
+    return "".join(parts)
 
-async def _decoding(bot_id, otext, group_id, cool_config=True, lexicon_id=0, lexicon_n=0, event_data=None):
+def _result_to_segments(result):
+    """将解码结果转换为OneBot消息段数组"""
+    if result.get("type") == "mixed":
+        messages = result.get("messages", [])
+    else:
+        messages = [{"type": "text", "content": result.get("content", "")}]
+    
+    segments = []
+    for msg in messages:
+        msg_type = msg.get("type")
+        if msg_type == "text":
+            segments.append({"type": "text", "data": {"text": msg.get("content", "")}})
+        elif msg_type in ("face", "reply"):
+            segments.append({"type": msg_type, "data": {"id": msg.get("id", "")}})
+        elif msg_type == "at":
+            segments.append({"type": "at", "data": {"qq": msg.get("qq", "")}})
+        elif msg_type in ("image", "video", "record"):
+            segments.append({"type": msg_type, "data": {"file": msg.get("url", "")}})
+        elif msg_type == "json":
+            segments.append({"type": "json", "data": {"data": json.dumps(msg.get("data"), ensure_ascii=False)}})
+        elif msg_type == "music":
+            # 自定义音乐分享需要audio，回复中只有一个链接，同时作为跳转链接和音频链接
+            url = msg.get("url", "")
+            segments.append({"type": "music", "data": {"type": "custom", "url": url, "audio": url, "title": msg.get("title", "")}})
+        elif msg_type == "share":
+            # 回复中只有链接，没有标题
+            segments.append({"type": "share", "data": {"url": msg.get("url", "")}})
+    return segments
+
+# 含有这些标记的回复每次解码结果可能不同，不能缓存
+_DYNAMIC_TOKEN_PATTERN = re.compile(
+    r'\((?:[YMDhms]\)|\d+-\d+\)|\d+~\)|\+|-\d+-\))'
+    r'|\{.*?[><=].*?\}'
+    r'|\[(?:group|群号|qq|QQ号|qq2|ai|AI号|name|QQ名|card|群昵称|id|消息id|词条id|词汇量|当前词库)\]',
+    re.S
+)
+
+def _is_static_reply(text):
+    """判断回复是否不含任何动态变量"""
+    return not _DYNAMIC_TOKEN_PATTERN.search(text)
+
+@traced("decode")
+async def _decoding(bot_id, otext, group_id, cool_config=True, lexicon_id=0, lexicon_n=None, event_data=None):
     """
     消息反编码 - 将内部格式转换为实际内容
     
@@ -669,7 +1739,7 @@ async def _decoding(bot_id, otext, group_id, cool_config=True, lexicon_id=0, lex
         group_id: 群组ID
         cool_config: 是否启用冷却
         lexicon_id: 词条ID（用于冷却）
-        lexicon_n: 词库词条数
+        lexicon_n: 词库词条数，为None时使用当前词库维护的计数
         event_data: 事件数据字典
     """
     
@@ -680,7 +1750,7 @@ async def _decoding(bot_id, otext, group_id, cool_config=True, lexicon_id=0, lex
             reply = await get_config(bot_id, '冷却中回复')
             if reply and '[冷却]' in reply:
                 reply = reply.replace('[冷却]', str(cooling_time))
-                logger.info(f"冷却中，剩余 {cooling_time} 秒")
+                decode_log.info("冷却中，剩余 %s 秒", cooling_time)
                 return {"type": "text", "content": reply}
     
     # 处理 [n.?] 变量
@@ -719,10 +1789,21 @@ async def _decoding(bot_id, otext, group_id, cool_config=True, lexicon_id=0, lex
     # 处理转义字符
     text = text.replace("\\n", "\n").replace("\\/", "/").replace("\\t", "\t").replace("\\r", "\r")
     
+    # 静态回复直接使用缓存结果
+    static_key = None
+    if DECODE_CACHE_SIZE > 0 and not isinstance(otext, list) and _is_static_reply(text):
+        static_key = text
+        cached = global_decode_cache.get(static_key)
+        if cached is not None:
+            metrics.cache_lookups.inc("decode", "hit")
+            decode_log.debug("命中静态回复缓存")
+            return cached[0]
+        metrics.cache_lookups.inc("decode", "miss")
+    
     # 检查分句发送
     clause = bool(re.search(r'\(-\d+-\)', text))
     if clause:
-        logger.info("检测到分句发送语法")
+        decode_log.info("检测到分句发送语法")
         # 这里可以返回特殊标记，让调用者处理分句发送
         return {"type": "clause", "content": text}
     
@@ -761,7 +1842,10 @@ async def _decoding(bot_id, otext, group_id, cool_config=True, lexicon_id=0, lex
     
     # 词库相关变量
     text = text.replace("[词条id]", str(lexicon_id))
-    text = text.replace("[词汇量]", str(int(lexicon_n) + 1))
+    if "[词汇量]" in text:
+        if lexicon_n is None:
+            lexicon_n = get_lexicon_index(bot_id).keyword_count
+        text = text.replace("[词汇量]", str(int(lexicon_n) + 1))
     
     # 当前词库
     current_lexicon = await get_select_file(bot_id)
@@ -802,7 +1886,7 @@ async def _decoding(bot_id, otext, group_id, cool_config=True, lexicon_id=0, lex
         
         await file_control(bot_id, f"cooling/{global_group_ids.get(bot_id, 'default')}.txt", "w", result)
         text = re.sub(r'\(\d+~\)', '', text)
-        logger.info(f"设置冷却时间: {cooling_seconds}秒")
+        decode_log.info("设置冷却时间: %s秒", cooling_seconds)
     
     # 处理随机数 (1-100)
     random_match = re.search(r'\((\d+)-(\d+)\)', text)
@@ -812,7 +1896,7 @@ async def _decoding(bot_id, otext, group_id, cool_config=True, lexicon_id=0, lex
             nums = list(map(int, m[1:-1].split('-')))
             rand_num = str(random.randint(nums[0], nums[1]))
             text = text.replace(m, rand_num, 1)
-        logger.debug(f"生成随机数: {matches}")
+        decode_log.debug("生成随机数: %s", matches)
     
     # 时间变量替换 (Y)、(M)、(D)、(h)、(m)、(s)
     now = datetime.now()
@@ -1001,13 +2085,243 @@ async def _decoding(bot_id, otext, group_id, cool_config=True, lexicon_id=0, lex
     
     # 如果只有一条文本消息，直接返回文本内容
     if len(result_messages) == 1 and result_messages[0]["type"] == "text":
-        return {"type": "text", "content": result_messages[0]["content"]}
+        result = {"type": "text", "content": result_messages[0]["content"]}
     elif len(result_messages) == 0:
-        return {"type": "text", "content": ""}
+        result = {"type": "text", "content": ""}
     else:
-        return {"type": "mixed", "messages": result_messages}
+        result = {"type": "mixed", "messages": result_messages}
+    
+    # 缓存静态回复的解码结果
+    if static_key is not None:
+        global_decode_cache.set(static_key, result)
+    
+    return result
 
 # ==================== HTTP请求工具 ====================
+def create_http_client():
+    """创建共享HTTP客户端"""
+    http2 = HTTP_USE_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            http_log.warn("未安装h2，HTTP/2已关闭")
+            http2 = False
+    
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        verify=False,
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        )
+    )
+
+def get_http_client():
+    """获取共享HTTP客户端，未初始化时自动创建"""
+    global http_client
+    if http_client is None or http_client.is_closed:
+        http_client = create_http_client()
+    return http_client
+
+async def close_http_client():
+    """关闭共享HTTP客户端"""
+    global http_client
+    if http_client is not None:
+        await http_client.aclose()
+        http_client = None
+        http_log.info("HTTP客户端已关闭")
+
+class HostGuard:
+    """单个上游主机的并发限制与熔断器"""
+    def __init__(self, host):
+        self.host = host
+        self.semaphore = asyncio.Semaphore(HTTP_HOST_CONCURRENCY)
+        self.results = deque(maxlen=HTTP_BREAKER_WINDOW)  # True为成功
+        self.state = "closed"  # closed / open / half_open
+        self.opened_at = 0.0
+        self.probe = None  # 半开状态下唯一放行的试探请求
+        self.in_flight = 0
+        self.rejected = 0
+    
+    def allow(self):
+        """熔断中直接拒绝（返回None），冷却结束后放行一个试探请求；返回值在请求结束后交给record"""
+        if self.state == "open":
+            if time.time() - self.opened_at < HTTP_BREAKER_COOLDOWN:
+                self.rejected += 1
+                return None
+            self.state = "half_open"
+            self.probe = object()
+            return self.probe
+        if self.state == "half_open":
+            self.rejected += 1
+            return None
+        return True
+    
+    def record(self, success, ticket=True):
+        """记录请求结果并更新熔断状态，熔断开启前发出的请求在熔断期间结束时不计入"""
+        if self.state == "open":
+            return
+        if self.state == "half_open":
+            if ticket is not self.probe:
+                return
+            self.probe = None
+            if success:
+                self.state = "closed"
+                self.results.clear()
+                http_log.info("上游恢复，关闭熔断: %s", self.host)
+            else:
+                self.state = "open"
+                self.opened_at = time.time()
+            return
+        
+        self.results.append(success)
+        failures = self.results.count(False)
+        if (len(self.results) >= HTTP_BREAKER_MIN_REQUESTS
+                and failures / len(self.results) >= HTTP_BREAKER_FAILURE_RATE):
+            self.state = "open"
+            self.opened_at = time.time()
+            http_log.warn("上游失败率过高，开启熔断: %s, 失败=%s/%s", self.host, failures, len(self.results))
+    
+    def stats(self):
+        return {
+            "state": self.state,
+            "in_flight": self.in_flight,
+            "recent_requests": len(self.results),
+            "recent_failures": self.results.count(False),
+            "rejected": self.rejected
+        }
+
+class DiskCache:
+    """外部请求的磁盘缓存，保存响应内容、ETag和Last-Modified"""
+    def __init__(self, path, max_bytes):
+        self.path = ensure_dir(path)
+        self.max_bytes = max_bytes
+        self._index = None  # key -> 文件大小，按最近使用排序
+        self.size_bytes = 0
+        self.evictions = 0
+    
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.json")
+    
+    def _load_index(self):
+        """首次使用时按修改时间建立索引"""
+        if self._index is not None:
+            return
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.is_file() and entry.name.endswith(".json"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name[:-5], stat.st_size))
+        files.sort()
+        self._index = OrderedDict((key, size) for _, key, size in files)
+        self.size_bytes = sum(self._index.values())
+    
+    def load(self, key):
+        """读取缓存条目，不存在时返回None"""
+        self._load_index()
+        if key not in self._index:
+            return None
+        try:
+            with open(self._file(key), 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            os.utime(self._file(key))
+            self._index.move_to_end(key)
+            return entry
+        except Exception as e:
+            http_log.error("读取磁盘缓存失败 %s: %s", key, e)
+            self.remove(key)
+            return None
+    
+    def save(self, key, entry):
+        """写入缓存条目，超出容量时淘汰最久未使用的文件"""
+        self._load_index()
+        content = json.dumps(entry, ensure_ascii=False)
+        size = len(content.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        try:
+            with open(self._file(key), 'w', encoding='utf-8') as f:
+                f.write(content)
+        except Exception as e:
+            http_log.error("写入磁盘缓存失败 %s: %s", key, e)
+            return
+        self.size_bytes += size - self._index.pop(key, 0)
+        self._index[key] = size
+        
+        while self._index and self.size_bytes > self.max_bytes:
+            old_key = next(iter(self._index))
+            self.remove(old_key)
+            self.evictions += 1
+    
+    def remove(self, key):
+        if self._index is not None and key in self._index:
+            self.size_bytes -= self._index.pop(key)
+        try:
+            os.remove(self._file(key))
+        except OSError:
+            pass
+    
+    def stats(self):
+        self._load_index()
+        return {
+            "entries": len(self._index),
+            "bytes": self.size_bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions
+        }
+
+def get_disk_cache():
+    """获取磁盘缓存，未启用时返回None"""
+    global disk_cache
+    if not HTTP_DISK_CACHE:
+        return None
+    if disk_cache is None:
+        disk_cache = DiskCache(os.path.join(get_data_dir(), "http_cache"), HTTP_DISK_CACHE_MAX_BYTES)
+    return disk_cache
+
+def parse_max_age(cache_control):
+    """解析Cache-Control，返回max-age秒数；no-store返回None，未指定返回默认TTL"""
+    directives = [d.strip().lower() for d in (cache_control or "").split(',')]
+    if "no-store" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    for directive in directives:
+        if directive.startswith("max-age="):
+            try:
+                return max(int(directive[8:]), 0)
+            except ValueError:
+                break
+    return HTTP_CACHE_TTL
+
+def get_host_guard(url):
+    """获取URL所属主机的HostGuard"""
+    host = urlparse(url).netloc
+    guard = global_host_guards.get(host)
+    if guard is None:
+        guard = HostGuard(host)
+        global_host_guards[host] = guard
+    return guard
+
+def http_status():
+    """外部请求的限制配置与各主机熔断状态"""
+    return {
+        "limits": {
+            "connect_timeout": HTTP_CONNECT_TIMEOUT,
+            "read_timeout": HTTP_READ_TIMEOUT,
+            "host_concurrency": HTTP_HOST_CONCURRENCY,
+            "max_connections": HTTP_MAX_CONNECTIONS,
+            "breaker_window": HTTP_BREAKER_WINDOW,
+            "breaker_min_requests": HTTP_BREAKER_MIN_REQUESTS,
+            "breaker_failure_rate": HTTP_BREAKER_FAILURE_RATE,
+            "breaker_cooldown": HTTP_BREAKER_COOLDOWN
+        },
+        "hosts": {host: guard.stats() for host, guard in global_host_guards.items()}
+    }
+
 async def get_data(url):
     """HTTP请求工具"""
     # URL编码处理
@@ -1017,99 +2331,247 @@ async def get_data(url):
     if second_index != -1:
         url = text[:second_index] + quote(text[second_index:])
     
-    logger.debug(f"HTTP请求: {url}")
+    http_log.debug("HTTP请求: %s", url)
+    
+    # 检查缓存
+    cache_key = hashlib.md5(url.encode()).hexdigest()
+    cached = global_cache.get(cache_key)
+    if cached is not None:
+        cached_data, fresh = cached
+        if fresh:
+            metrics.get_data_requests.inc("cache_fresh")
+            http_log.debug("使用缓存: %s", url)
+        else:
+            # 已过期：先返回旧数据，后台刷新
+            metrics.get_data_requests.inc("cache_stale")
+            http_log.debug("使用过期缓存并后台刷新: %s", url)
+            start_fetch(url, cache_key)
+        return cached_data
+    
+    metrics.get_data_requests.inc("coalesced" if cache_key in global_inflight_requests else "fetch")
     
+    # 同一URL的并发请求共享一次上游请求
+    return await asyncio.shield(start_fetch(url, cache_key))
+
+def start_fetch(url, cache_key):
+    """发起上游请求，已有相同请求进行中时直接复用"""
+    task = global_inflight_requests.get(cache_key)
+    if task is None:
+        task = asyncio.create_task(fetch_data(url, cache_key))
+        global_inflight_requests[cache_key] = task
+        task.add_done_callback(lambda _: global_inflight_requests.pop(cache_key, None))
+    else:
+        http_log.debug("合并进行中的请求: %s", url)
+    return task
+
+async def fetch_data(url, cache_key):
+    """请求上游并写入缓存"""
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
     }
     
-    # 检查缓存
-    cache_key = hashlib.md5(url.encode()).hexdigest()
-    if cache_key in global_cache:
-        cached_time, cached_data = global_cache[cache_key]
-        if time.time() - cached_time < 300:  # 5分钟缓存
-            logger.debug(f"使用缓存: {url}")
-            return cached_data
-    
+    # 磁盘缓存：未过期直接使用，否则带上条件请求头重新验证
+    disk = get_disk_cache()
+    disk_entry = disk.load(cache_key) if disk else None
+    if disk_entry:
+        if disk_entry.get("expires", 0) > time.time():
+            http_log.debug("使用磁盘缓存: %s", url)
+            metrics.get_data_fetches.inc("disk")
+            global_cache.set(cache_key, disk_entry["body"], disk_entry["expires"] - time.time())
+            return disk_entry["body"]
+        if disk_entry.get("etag"):
+            headers["If-None-Match"] = disk_entry["etag"]
+        if disk_entry.get("last_modified"):
+            headers["If-Modified-Since"] = disk_entry["last_modified"]
+    
+    guard = get_host_guard(url)
+    ticket = guard.allow()
+    if not ticket:
+        http_log.warn("上游熔断中，跳过请求: %s", url)
+        metrics.get_data_fetches.inc("breaker_open")
+        return disk_entry["body"] if disk_entry else ""
+    
+    success = False
+    guard.in_flight += 1
     try:
-        async with httpx.AsyncClient(timeout=60, verify=False) as client:
-            resp = await client.get(url, headers=headers)
+        async with guard.semaphore:
+            started = time.perf_counter()
+            try:
+                resp = await get_http_client().get(url, headers=headers)
+            finally:
+                metrics.get_data_seconds.observe(time.perf_counter() - started)
+        success = resp.status_code < 500
+        
+        if resp.status_code == 304 and disk_entry:
+            http_log.debug("上游内容未变化: %s", url)
+            metrics.get_data_fetches.inc("not_modified")
+            data = disk_entry["body"]
+        else:
+            metrics.get_data_fetches.inc("ok" if success else "server_error")
             data = resp.text.strip()
-            # 更新缓存
-            global_cache[cache_key] = (time.time(), data)
+        
+        # 只缓存2xx和304，错误页不缓存；内存和磁盘缓存都遵守max-age和no-store
+        if not (200 <= resp.status_code < 300 or (resp.status_code == 304 and disk_entry)):
             return data
+        max_age = parse_max_age(resp.headers.get("Cache-Control"))
+        if max_age is None:
+            global_cache.pop(cache_key)
+        else:
+            global_cache.set(cache_key, data, max_age)
+            if disk:
+                disk.save(cache_key, {
+                        "url": url,
+                        "body": data,
+                        "etag": resp.headers.get("ETag") or (disk_entry or {}).get("etag"),
+                        "last_modified": resp.headers.get("Last-Modified") or (disk_entry or {}).get("last_modified"),
+                        "expires": time.time() + max_age
+                    })
+        return data
     except httpx.HTTPError as e:
-        logger.error(f"HTTP请求失败: {e}")
-        return ""
+        http_log.error("HTTP请求失败: %s", e)
+        metrics.get_data_fetches.inc("error")
+        return disk_entry["body"] if disk_entry else ""
     except asyncio.TimeoutError:
-        logger.error(f"HTTP请求超时: {url}")
-        return ""
+        http_log.error("HTTP请求超时: %s", url)
+        metrics.get_data_fetches.inc("timeout")
+        return disk_entry["body"] if disk_entry else ""
     except Exception as e:
-        logger.error(f"HTTP请求异常: {e}")
-        return ""
+        http_log.error("HTTP请求异常: %s", e)
+        metrics.get_data_fetches.inc("error")
+        return disk_entry["body"] if disk_entry else ""
+    finally:
+        guard.in_flight -= 1
+        guard.record(success, ticket)
+
+@functools.lru_cache(maxsize=256)
+def _parse_key_mapping(mapping_str):
+    """解析 "旧键=新键,旧键2=" 形式的键名映射，结果会被缓存"""
+    mapping = {}
+    for item in mapping_str.split(','):
+        if item.strip():
+            kv = item.split('=', 1)
+            if len(kv) == 2:
+                mapping[kv[0].strip()] = kv[1].strip()
+    return mapping
+
+@functools.lru_cache(maxsize=256)
+def _parse_json_path(path):
+    """解析 "data.list[0].name" 形式的路径，*匹配全部子项"""
+    return tuple(token for token in re.split(r'\.|\[|\]', path.strip()) if token)
+
+def extract_json_path(data, path):
+    """按路径提取字段，返回所有匹配的值"""
+    nodes = [data]
+    for token in _parse_json_path(path):
+        matched = []
+        for node in nodes:
+            if isinstance(node, dict):
+                if token == '*':
+                    matched.extend(node.values())
+                elif token in node:
+                    matched.append(node[token])
+            elif isinstance(node, list):
+                if token == '*':
+                    matched.extend(node)
+                elif token.lstrip('-').isdigit() and -len(node) <= int(token) < len(node):
+                    matched.append(node[int(token)])
+        nodes = matched
+        if not nodes:
+            break
+    return nodes
+
+def _format_json_value(value):
+    if value is None:
+        return "null"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
 
-def json_to_text(data, indent=0, key_mapping=None):
-    """JSON转文本工具"""
-    # 解析键名映射
+def json_to_text(data, indent=0, key_mapping=None, paths=None):
+    """
+    JSON转文本工具
+    
+    Args:
+        data: JSON字符串/字节或已解析的数据
+        indent: 起始缩进
+        key_mapping: 键名映射，字典或 "旧键=新键,旧键2=" 字符串，映射为空时隐藏该键
+        paths: 只输出指定路径的字段，如 "data.title" 或 ["data.list.*.name", "code"]
+    """
     if isinstance(key_mapping, str):
-        key_mapping = {}
-        for item in key_mapping.split(','):
-            if item.strip():
-                kv = item.split('=', 1)
-                if len(kv) == 2:
-                    key_mapping[kv[0].strip()] = kv[1].strip()
+        key_mapping = _parse_key_mapping(key_mapping)
+    key_mapping = key_mapping or {}
     
     try:
-        if isinstance(data, str):
-            data = json.loads(data)
+        if isinstance(data, (str, bytes)):
+            data = json_loads(data)
     except:
         return data
     
-    result = []
-    space = ' ' * indent
+    # 路径提取：只渲染需要的字段
+    if paths:
+        if isinstance(paths, str):
+            paths = [p for p in paths.split(',') if p.strip()]
+        if len(paths) == 1:
+            matches = extract_json_path(data, paths[0])
+            data = matches[0] if len(matches) == 1 else matches
+        else:
+            selected = {}
+            for path in paths:
+                matches = extract_json_path(data, path)
+                if matches:
+                    selected[path.strip()] = matches[0] if len(matches) == 1 else matches
+            data = selected
     
-    def format_value(value):
-        if value is None:
-            return "null"
-        if isinstance(value, bool):
-            return "true" if value else "false"
-        if isinstance(value, (int, float)):
-            return str(value)
-        if isinstance(value, str):
-            return value
-        return str(value)
-    
-    if isinstance(data, dict):
-        keys_to_remove = []
-        for key, value in data.items():
-            if key_mapping and key in key_mapping and key_mapping[key] == "":
-                keys_to_remove.append(key)
+    if not isinstance(data, (dict, list)):
+        return f"{' ' * indent}{_format_json_value(data)}"
+    
+    # 迭代遍历，避免深层数据递归和中间字符串拼接
+    lines = []
+    stack = []
+    
+    def open_container(value, level, trim):
+        if value:
+            items = iter(value.items()) if isinstance(value, dict) else iter(value)
+            # 列表项中的容器与"- "衔接，结束时去掉首尾空白
+            stack.append((items, isinstance(value, dict), level, len(lines), trim))
+        else:
+            lines.append("")
+    
+    open_container(data, indent, False)
+    while stack:
+        items, is_dict, level, start, trim = stack[-1]
+        item = next(items, stack)
+        if item is stack:
+            stack.pop()
+            if len(lines) == start:
+                lines.append("")
+            elif trim:
+                while len(lines) > start + 1 and not lines[start].strip():
+                    del lines[start]
+                lines[start] = lines[start].lstrip()
+                while len(lines) > start + 1 and not lines[-1].strip():
+                    lines.pop()
+                lines[-1] = lines[-1].rstrip()
+            continue
+        
+        space = ' ' * level
+        if is_dict:
+            key, value = item
+            mapped_key = key_mapping.get(key, key)
+            if mapped_key == "":
                 continue
-            
-            mapped_key = key_mapping.get(key, key) if key_mapping else key
-            
             if isinstance(value, (dict, list)):
-                result.append(f"{space}{mapped_key}:")
-                result.append(json_to_text(value, indent + 1, key_mapping))
+                lines.append(f"{space}{mapped_key}:")
+                open_container(value, level + 1, False)
             else:
-                result.append(f"{space}{mapped_key}: {format_value(value)}")
-        
-        for key in keys_to_remove:
-            data.pop(key, None)
-        
-        return '\n'.join(result)
-    
-    elif isinstance(data, list):
-        for item in data:
-            if isinstance(item, (dict, list)):
-                result.append(f"{space}- ")
-                result.append(json_to_text(item, indent + 1, key_mapping).strip())
-            else:
-                result.append(f"{space}- {format_value(item)}")
-        return '\n'.join(result)
+                lines.append(f"{space}{mapped_key}: {_format_json_value(value)}")
+        elif isinstance(item, (dict, list)):
+            lines.append(f"{space}- ")
+            open_container(item, level + 1, True)
+        else:
+            lines.append(f"{space}- {_format_json_value(item)}")
     
-    else:
-        return f"{space}{format_value(data)}"
+    return '\n'.join(lines)
 
 # ==================== API相关定义 ====================
 security = HTTPBearer()
@@ -1121,48 +2583,297 @@ async def verify_token(credentials: HTTPAuthorizationCredentials = Depends(secur
         raise HTTPException(status_code=401, detail="无效的Token")
     return credentials.credentials
 
-class KeywordRequest(BaseModel):
-    action: str
-    mode: int = 0
-    botid: int  # 改为int类型
-    userid: int  # 改为int类型
-    groupid: Optional[int] = None
-    msg: Optional[str] = ""
-    keyword: Optional[str] = None
-    reply: Optional[str] = None
-    token: str
+# ==================== 请求模型 ====================
+class ActionRequest(BaseModel):
+    """请求基类"""
+    model_config = ConfigDict(extra="ignore")
     
-    # 添加验证器处理大整数
-    @validator('botid', 'userid', pre=True)
+    token: str = ""
+
+class BotActionRequest(ActionRequest):
+    """需要机器人和用户信息的请求"""
+    botid: int = 0
+    userid: int = 0
+    
+    # 添加验证器处理大整数，无法识别时按缺少参数处理
+    @field_validator('botid', 'userid', mode='before')
+    @classmethod
     def validate_ids(cls, v):
-        # 确保正确处理大整数
-        if isinstance(v, str) and v.isdigit():
-            try:
-                return int(v)
-            except ValueError:
-                try:
-                    return int(v)
-                except:
-                    return 0
-        elif isinstance(v, int):
-            return v
+        if isinstance(v, str):
+            return int(v) if v.isdigit() else 0
+        elif isinstance(v, bool) or v is None:
+            return 0
         elif isinstance(v, float):
             return int(v)
-        return 0
+        return v
+
+class QueryRequest(BotActionRequest):
+    action: Literal["query"]
+    groupid: Optional[int] = None
+    msg: str = ""
+    message: Optional[List[Dict[str, Any]]] = None  # OneBot消息段数组
+    mode: int = 0
+
+class DecodeRequest(BotActionRequest):
+    action: Literal["decode"]
+    groupid: Optional[int] = None
+    text: Union[str, List[str]] = ""
+    message: Optional[List[Dict[str, Any]]] = None
+    lexicon_id: int = 0
+    lexicon_n: Optional[int] = None
+    event_data: Dict[str, Any] = {}
+    cool_config: bool = True
+    segments: bool = False
+
+class DecodeBatchItem(BaseModel):
+    """批量解码中的单项"""
+    text: Union[str, List[str]] = ""
+    message: Optional[List[Dict[str, Any]]] = None
+    lexicon_id: int = 0
+    lexicon_n: Optional[int] = None
+
+class DecodeBatchRequest(BotActionRequest):
+    action: Literal["decode_batch"]
+    groupid: Optional[int] = None
+    texts: List[Any] = []  # 单项在处理时校验，出错不影响整批
+    lexicon_n: Optional[int] = None
+    event_data: Dict[str, Any] = {}
+    cool_config: bool = True
+    segments: bool = False
+
+class RespondRequest(BotActionRequest):
+    action: Literal["respond"]
+    groupid: Optional[int] = None
+    event: Dict[str, Any] = {}
+    msg: Optional[str] = None
+    message: Optional[List[Dict[str, Any]]] = None
+    event_data: Optional[Dict[str, Any]] = None
+    lexicon_n: Optional[int] = None
+    cool_config: bool = True
+    segments: bool = False
+
+class TranscodeRequest(ActionRequest):
+    action: Literal["transcode"]
+    text: str = ""
+
+class AddRequest(BotActionRequest):
+    action: Literal["add"]
+    keyword: Optional[str] = None
+    reply: Optional[str] = None
+    mode: int = 1  # 默认为精确匹配
+
+class RemoveRequest(BotActionRequest):
+    action: Literal["remove"]
+    keyword: Optional[str] = None
+
+class AddReplyRequest(BotActionRequest):
+    action: Literal["add_r"]
+    keyword: Optional[str] = None
+    reply: Optional[str] = None
+
+class RemoveReplyRequest(BotActionRequest):
+    action: Literal["remove_r"]
+    keyword: Optional[str] = None
+    reply: Optional[str] = None
+
+class GetConfigRequest(BotActionRequest):
+    action: Literal["get_config"]
+
+class SearchRequest(BotActionRequest):
+    action: Literal["search"]
+    keyword: Optional[str] = None
+    limit: Optional[int] = Field(None, ge=1)  # 最多返回的结果数，默认全部返回
+
+class ListRequest(BotActionRequest):
+    action: Literal["list"]
+    offset: int = Field(0, ge=0)
+    limit: int = Field(LIST_DEFAULT_LIMIT, ge=1, le=LIST_MAX_LIMIT)
+    cursor: Optional[str] = None  # 上一页返回的next_cursor，优先于offset
+
+class CountRequest(BotActionRequest):
+    action: Literal["count"]
+
+class TestRequest(BotActionRequest):
+    action: Literal["test"]
+
+class AdminManageRequest(ActionRequest):
+    action: Literal["admin_manage"]
+    op: str = "view"
+    user: Optional[str] = None
+    
+    @field_validator('user', mode='before')
+    @classmethod
+    def validate_user(cls, v):
+        return str(v) if isinstance(v, int) else v
+
+KeywordRequest = Annotated[
+    Union[
+        QueryRequest, DecodeRequest, DecodeBatchRequest, RespondRequest,
+        TranscodeRequest, AddRequest, RemoveRequest, AddReplyRequest,
+        RemoveReplyRequest, GetConfigRequest, SearchRequest, ListRequest,
+        CountRequest, TestRequest, AdminManageRequest
+    ],
+    Field(discriminator="action")
+]
+keyword_request_adapter = TypeAdapter(KeywordRequest)
+
+class BatchRequest(BaseModel):
+    """批量操作请求，每项与/api/v1/keyword的请求体相同（无需token）"""
+    token: str = ""
+    requests: List[Dict[str, Any]] = []
+
+# 手动校验请求体的接口不会自动生成文档，请求模型在这里生成并在/openapi.json中补充
+openapi_request_schemas = {}
+
+def _openapi_schema(adapter):
+    """生成请求模型的JSON Schema，引用的子模型放入OpenAPI的components"""
+    schema = adapter.json_schema(ref_template="#/components/schemas/{model}")
+    openapi_request_schemas.update(schema.pop("$defs", {}))
+    return schema
+
+def _openapi_request_body(schema):
+    return {"requestBody": {"content": {"application/json": {"schema": schema}}, "required": True}}
+
+keyword_request_schema = _openapi_schema(keyword_request_adapter)
+batch_request_schema = _openapi_schema(TypeAdapter(BatchRequest))
+batch_request_schema["properties"]["requests"]["items"] = keyword_request_schema
+
+class FastJSONResponse(JSONResponse):
+    """使用高速JSON库序列化的响应"""
+    def render(self, content: Any) -> bytes:
+        return json_dumps_bytes(content)
+
+class CompressionMiddleware:
+    """响应压缩中间件 - 按Accept-Encoding选择brotli或gzip，小响应和已压缩的内容不处理"""
+    
+    EXCLUDED_TYPES = ("image/", "audio/", "video/", "application/zip", "application/gzip", "text/event-stream")
+    THREAD_MIN_SIZE = 256 * 1024  # 超过该大小的数据块在线程中压缩，避免阻塞事件循环
+    
+    def __init__(self, app, minimum_size=COMPRESS_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+    
+    @staticmethod
+    def select_encoding(accept_encoding):
+        """从Accept-Encoding中选择压缩算法"""
+        accepted = set()
+        for part in accept_encoding.lower().split(","):
+            name, _, params = part.partition(";")
+            params = params.replace(" ", "")
+            if params.startswith("q=") and params[2:] in ("0", "0.0", "0.00", "0.000"):
+                continue
+            accepted.add(name.strip())
+        if brotli is not None and "br" in accepted:
+            return "br"
+        if "gzip" in accepted:
+            return "gzip"
+        return None
     
-    class Config:
-        extra = "allow"
-        json_encoders = {
-            int: lambda v: v,
-            float: lambda v: v,
-        }
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        
+        encoding = self.select_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if not encoding:
+            await self.app(scope, receive, send)
+            return
+        
+        start_message = None
+        compressor = None
+        passthrough = False
+        
+        def compress(body, more_body):
+            if encoding == "br":
+                data = compressor.process(body)
+                return data + (compressor.flush() if more_body else compressor.finish())
+            data = compressor.compress(body)
+            return data + compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+        
+        async def apply(body, more_body):
+            if len(body) >= self.THREAD_MIN_SIZE:
+                return await asyncio.get_running_loop().run_in_executor(None, compress, body, more_body)
+            return compress(body, more_body)
+        
+        async def send_compressed(message):
+            nonlocal start_message, compressor, passthrough
+            if message["type"] == "http.response.start":
+                headers = Headers(raw=message["headers"])
+                content_type = headers.get("content-type", "").lower()
+                passthrough = (
+                    "content-encoding" in headers
+                    or message["status"] == 206
+                    or content_type.startswith(self.EXCLUDED_TYPES)
+                )
+                if passthrough:
+                    await send(message)
+                else:
+                    start_message = message
+                return
+            if passthrough or message["type"] != "http.response.body":
+                await send(message)
+                return
+            
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start_message is not None:
+                headers = MutableHeaders(raw=start_message["headers"])
+                headers.add_vary_header("Accept-Encoding")
+                if len(body) < self.minimum_size and not more_body:
+                    # 小响应直接发送
+                    passthrough = True
+                    await send(start_message)
+                    await send(message)
+                    return
+                if encoding == "br":
+                    compressor = brotli.Compressor(quality=COMPRESS_BROTLI_QUALITY)
+                else:
+                    compressor = zlib.compressobj(COMPRESS_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+                body = await apply(body, more_body)
+                headers["Content-Encoding"] = encoding
+                if more_body:
+                    del headers["Content-Length"]
+                else:
+                    headers["Content-Length"] = str(len(body))
+                await send(start_message)
+                start_message = None
+            else:
+                body = await apply(body, more_body)
+            await send({"type": "http.response.body", "body": body, "more_body": more_body})
+        
+        await self.app(scope, receive, send_compressed)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期 - 启动时创建HTTP客户端，关闭时释放连接"""
+    get_http_client()
+    logger.info("HTTP客户端已创建")
+    try:
+        yield
+    finally:
+        await close_http_client()
 
 # 创建FastAPI应用
 api_app = FastAPI(
     title="VanBot关键词API",
     description="提供关键词查询和管理功能的API接口",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
+if COMPRESS_RESPONSES:
+    api_app.add_middleware(CompressionMiddleware)
+
+_default_openapi = api_app.openapi
+
+def _openapi_with_request_models():
+    """默认文档加上手动校验的请求模型定义"""
+    if api_app.openapi_schema is None:
+        schema = _default_openapi()
+        schema.setdefault("components", {}).setdefault("schemas", {}).update(openapi_request_schemas)
+    return api_app.openapi_schema
+
+api_app.openapi = _openapi_with_request_models
 
 # ==================== WebUI HTML模板 ====================
 WEBUI_HTML = """
@@ -2541,6 +4252,7 @@ WEBUI_HTML = """
                 botid: parseInt(botid),
                 userid: parseInt(userid),
                 keyword: keyword,
+                limit: 100,
                 token: apiToken
             };
             
@@ -2949,6 +4661,13 @@ async def get_status():
         "token": API_TOKEN[:8] + "..." if len(API_TOKEN) > 8 else API_TOKEN,
         "running": True,
         "data_dir": data_dir,
+        "json_backend": json_backend,
+        "decode_cache": global_decode_cache.stats(),
+        "transcode_cache": global_transcode_cache.stats(),
+        "http_cache": global_cache.stats(),
+        "http_disk_cache": get_disk_cache().stats() if HTTP_DISK_CACHE else None,
+        "http": http_status(),
+        "lexicons": lexicon_status(),
         "features": [
             "关键词查询",
             "词条管理",
@@ -2962,6 +4681,13 @@ async def get_status():
         ]
     }
 
+@api_app.get("/metrics")
+async def get_metrics():
+    """Prometheus监控指标"""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="监控接口未开启")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @api_app.get("/webui")
 async def webui():
     """WebUI主界面"""
@@ -2969,76 +4695,344 @@ async def webui():
     html_content = WEBUI_HTML.replace("{{api_token}}", API_TOKEN)
     return HTMLResponse(content=html_content)
 
+def validation_http_error(e: ValidationError):
+    """将请求校验错误转换为HTTP异常：不支持的action为400，其余为422"""
+    errors = e.errors(include_url=False, include_context=False, include_input=False)
+    if errors and errors[0]["type"] in ("union_tag_invalid", "union_tag_not_found"):
+        action = (e.errors(include_url=False)[0].get("ctx") or {}).get("tag", "")
+        logger.error(f"不支持的操作: {action}")
+        return HTTPException(status_code=400, detail=f"不支持的操作: {action}")
+    logger.error(f"请求参数校验失败: {errors}")
+    return HTTPException(status_code=422, detail=errors)
+
+@api_app.exception_handler(StarletteHTTPException)
+async def http_error_handler(request: Request, exc: StarletteHTTPException):
+    """错误响应同样带上X-Request-ID，便于在日志中找到失败的请求"""
+    response = await http_exception_handler(request, exc)
+    request_id = getattr(request.state, "request_id", None)
+    if request_id:
+        response.headers["X-Request-ID"] = request_id
+    return response
+
 # 主要API端点
-@api_app.post("/api/v1/keyword")
+@api_app.post("/api/v1/keyword", openapi_extra=_openapi_request_body(keyword_request_schema))
 async def keyword_api(
-    request_data: Dict[str, Any] = Body(...),
+    request: Request,
+    response: Response,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """关键词API主接口 - 按action校验为对应的请求模型后分发"""
+    
+    # 追踪本次请求，结束时记录各阶段耗时；在认证和校验之前开始，失败的请求也计入指标
+    with RequestTrace(request_id=request.headers.get("x-request-id")) as trace:
+        response.headers["X-Request-ID"] = trace.request_id
+        request.state.request_id = trace.request_id  # 出错时由异常处理器加到错误响应上
+        
+        # 验证Header中的Token
+        if credentials.credentials != API_TOKEN:
+            logger.error(f"Header Token验证失败: {credentials.credentials}")
+            raise HTTPException(status_code=401, detail="无效的Token")
+        
+        try:
+            # 直接由pydantic-core解析并校验请求体
+            req = keyword_request_adapter.validate_json(await request.body())
+        except ValidationError as e:
+            raise validation_http_error(e)
+        trace.bind(req)
+        
+        logger.info(f"收到API请求: action={req.action}, botid={getattr(req, 'botid', None)}")
+        
+        try:
+            # 验证请求体中的Token
+            if req.token != API_TOKEN:
+                logger.error(f"Body Token验证失败: {req.token}")
+                raise HTTPException(status_code=401, detail="Token验证失败")
+            
+            return await ACTION_HANDLERS[req.action](req)
+        except HTTPException as he:
+            logger.error(f"HTTP异常: {he.detail}")
+            raise
+        except Exception as e:
+            logger.error(f"处理请求时出错: {e}")
+            import traceback
+            traceback.print_exc()
+            raise HTTPException(status_code=500, detail=str(e))
+
+# 批量API端点
+@api_app.post("/api/v1/batch", openapi_extra=_openapi_request_body(batch_request_schema))
+async def batch_api(
+    request: Request,
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
-    """关键词API主接口 - 直接接收字典"""
+    """批量API接口 - 一次请求执行多个操作，逐项返回结果"""
     
     # 验证Header中的Token
     if credentials.credentials != API_TOKEN:
         logger.error(f"Header Token验证失败: {credentials.credentials}")
         raise HTTPException(status_code=401, detail="无效的Token")
     
-    logger.info(f"收到API请求: action={request_data.get('action')}, botid={request_data.get('botid')}")
+    try:
+        batch = BatchRequest.model_validate_json(await request.body())
+    except ValidationError as e:
+        raise validation_http_error(e)
+    
+    # 验证请求体中的Token（整批只验证一次）
+    if batch.token != API_TOKEN:
+        logger.error(f"Body Token验证失败: {batch.token}")
+        raise HTTPException(status_code=401, detail="Token验证失败")
+    
+    if len(batch.requests) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"单次最多 {BATCH_MAX_ITEMS} 个操作")
+    
+    batch_id = request.headers.get("x-request-id") or uuid.uuid4().hex[:16]
+    logger.info(f"收到批量请求: id={batch_id}, 操作数={len(batch.requests)}")
     
+    # 同一机器人的操作共享全局上下文，按顺序执行；不同机器人之间并发执行
+    lanes = {}
+    for index, item in enumerate(batch.requests):
+        lane = action_lane(item) or f"item:{index}"
+        lanes.setdefault(lane, []).append((index, item))
+    
+    results = [None] * len(batch.requests)
+    
+    async def run_lane(entries):
+        for index, item in entries:
+            results[index] = {"index": index, **await run_action(item, f"{batch_id}-{index}")}
+    
+    await asyncio.gather(*(run_lane(entries) for entries in lanes.values()))
+    
+    success_count = sum(1 for r in results if r["success"])
+    logger.info(f"批量请求完成: 成功={success_count}, 失败={len(results) - success_count}")
+    return {
+        "success": True,
+        "results": results,
+        "count": len(results),
+        "timestamp": time.time()
+    }
+
+def action_lane(item):
+    """操作的执行通道：同一机器人的操作需要按顺序执行，返回None表示可独立执行"""
+    botid = item.get("botid") or (item.get("event") or {}).get("self_id")
+    if botid:
+        # 与请求模型使用同样的转换，"123"和123是同一个机器人，必须进入同一通道
+        return f"bot:{BotActionRequest.validate_ids(botid)}"
+    if item.get("action") == "admin_manage":
+        return "admin"
+    return None
+
+async def run_action(item, request_id=None):
+    """执行批量/WebSocket请求中的单个操作，错误只影响该项"""
     try:
-        # 验证请求体中的Token
-        if request_data.get("token") != API_TOKEN:
-            logger.error(f"Body Token验证失败: {request_data.get('token')}")
-            raise HTTPException(status_code=401, detail="Token验证失败")
-        
-        action = request_data.get("action", "")
-        
-        # 根据action执行不同的操作
-        if action == "query":
-            return await handle_query_direct(request_data)
-        elif action == "decode":
-            return await handle_decode_direct(request_data)
-        elif action == "add":
-            return await handle_add_direct(request_data)
-        elif action == "remove":
-            return await handle_remove_direct(request_data)
-        elif action == "remove_r":
-            return await handle_remove_reply_direct(request_data)
-        elif action == "add_r":
-            return await handle_add_reply_direct(request_data)
-        elif action == "get_config":
-            return await handle_get_config_direct(request_data)
-        elif action == "search":
-            return await handle_search_direct(request_data)
-        elif action == "list":
-            return await handle_list_direct(request_data)
-        elif action == "count":
-            return await handle_count_direct(request_data)
-        elif action == "test":
-            return await handle_test_direct(request_data)
-        elif action == "transcode":
-            return await handle_transcode_direct(request_data)
-        elif action == "admin_manage":
-            return await handle_admin_manage_direct(request_data)
-        else:
-            logger.error(f"不支持的操作: {action}")
-            raise HTTPException(status_code=400, detail=f"不支持的操作: {action}")
-    except HTTPException as he:
-        logger.error(f"HTTP异常: {he.detail}")
-        raise
-    except Exception as e:
-        logger.error(f"处理请求时出错: {e}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=str(e))
+        req = keyword_request_adapter.validate_python(item)
+    except ValidationError as e:
+        he = validation_http_error(e)
+        return {"success": False, "status": he.status_code, "error": he.detail}
+    
+    with RequestTrace.from_request(req, request_id) as trace:
+        try:
+            result = await ACTION_HANDLERS[req.action](req)
+            return {"success": True, "result": result}
+        except HTTPException as he:
+            trace.status = he.status_code
+            logger.error(f"操作 {req.action} 失败: {he.detail}")
+            return {"success": False, "status": he.status_code, "error": he.detail}
+        except Exception as e:
+            trace.status = 500
+            logger.error(f"操作 {req.action} 出错: {e}")
+            return {"success": False, "status": 500, "error": str(e)}
+
+# 词库导入导出
+async def _load_lexicon_params(botid, userid):
+    """解析URL中的botid和userid并加载对应词库"""
+    if not (botid.isdigit() and userid.isdigit()):
+        raise HTTPException(status_code=400, detail="缺少botid或userid参数")
+    botid, userid = int(botid), int(userid)
+    await _global_file(botid, userid, None, f"M_{userid}")
+    return botid, userid
+
+def _export_response(botid, userid, fmt):
+    if fmt not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的格式: {fmt}")
+    media_type, ext = EXPORT_FORMATS[fmt]
+    work = datas.get(botid, {"work": []})["work"]
+    return StreamingResponse(
+        export_lexicon_chunks(work, fmt),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="M_{userid}.{ext}"'}
+    )
+
+@api_app.get("/api/v1/list/stream")
+async def list_stream_api(botid: str, userid: str, token: str = Depends(verify_token)):
+    """以NDJSON格式流式导出完整词库，每行一个词条"""
+    botid, userid = await _load_lexicon_params(botid, userid)
+    logger.info(f"流式导出词条: botid={botid}, userid={userid}")
+    return _export_response(botid, userid, "ndjson")
+
+@api_app.get("/api/v1/export")
+async def export_api(botid: str, userid: str, format: str = "json", token: str = Depends(verify_token)):
+    """流式导出词库 - 支持json（词库文件格式）、ndjson、csv"""
+    botid, userid = await _load_lexicon_params(botid, userid)
+    logger.info(f"导出词库: botid={botid}, userid={userid}, format={format}")
+    return _export_response(botid, userid, format)
+
+@api_app.post("/api/v1/import")
+async def import_api(
+    request: Request,
+    botid: str,
+    userid: str,
+    format: str = "json",
+    mode: str = "merge",
+    token: str = Depends(verify_token)
+):
+    """批量导入词库 - 请求体为json/ndjson/csv内容，merge合并到现有词库，replace替换整个词库"""
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的格式: {format}")
+    if mode not in ("merge", "replace"):
+        raise HTTPException(status_code=400, detail=f"不支持的导入模式: {mode}")
+    
+    try:
+        content = (await request.body()).decode("utf-8-sig")
+    except UnicodeDecodeError:
+        raise HTTPException(status_code=400, detail="导入内容必须是UTF-8编码")
+    
+    # 先完整校验，有错误时不做任何修改
+    entries, errors = parse_import_entries(content, format)
+    if errors:
+        logger.error(f"导入校验失败: {len(errors)} 个错误")
+        raise HTTPException(status_code=400, detail={
+            "message": f"导入内容有 {len(errors)} 个错误",
+            "errors": errors[:IMPORT_MAX_ERRORS]
+        })
+    
+    botid, userid = await _load_lexicon_params(botid, userid)
+    logger.info(f"导入词库: botid={botid}, userid={userid}, format={format}, mode={mode}, 词条数={len(entries)}")
+    
+    result, added_keywords, added_replies = import_lexicon(botid, entries, replace=(mode == "replace"))
+    with trace_stage("persist"):
+        save_result = await file_control(botid, data_files[botid], "w", result)
+    if save_result != "写入成功":
+        logger.error(f"导入词库保存失败: botid={botid}")
+        raise HTTPException(status_code=500, detail="保存失败")
+    
+    index = get_lexicon_index(botid)
+    return {
+        "success": True,
+        "action": "import",
+        "mode": mode,
+        "imported": len(entries),
+        "added_keywords": added_keywords,
+        "added_replies": added_replies,
+        "keyword_count": index.keyword_count,
+        "reply_count": index.reply_count,
+        "timestamp": time.time()
+    }
+
+# WebSocket端点
+@api_app.websocket("/ws")
+async def websocket_api(websocket: WebSocket):
+    """WebSocket接口 - 认证一次后持续接收带id的请求帧，处理完成即返回（不保证顺序）"""
+    await websocket.accept()
+    
+    async def receive_text():
+        """接收一帧，二进制帧返回None，连接断开时抛出WebSocketDisconnect"""
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            raise WebSocketDisconnect(message.get("code", 1000))
+        return message.get("text")
+    
+    # 认证：Header/URL参数中的Token，或者首帧 {"token": "..."}
+    token = websocket.query_params.get("token", "")
+    auth_header = websocket.headers.get("authorization", "")
+    if auth_header.lower().startswith("bearer "):
+        token = auth_header[7:].strip()
+    if token != API_TOKEN:
+        try:
+            first = json_loads(await receive_text() or "null")
+        except WebSocketDisconnect:
+            logger.info("WebSocket连接在认证前断开")
+            return
+        except Exception:
+            first = None
+        if not isinstance(first, dict) or first.get("token") != API_TOKEN:
+            logger.error("WebSocket Token验证失败")
+            await websocket.send_text(json_dumps({"type": "auth", "success": False, "error": "无效的Token"}))
+            await websocket.close(code=1008)
+            return
+    await websocket.send_text(json_dumps({"type": "auth", "success": True}))
+    logger.info("WebSocket连接已认证")
+    
+    connection_id = uuid.uuid4().hex[:12]
+    inflight = asyncio.Semaphore(WS_MAX_INFLIGHT)
+    send_lock = asyncio.Lock()
+    lane_locks = {}  # 通道 -> [锁, 使用中的请求数]，没有请求使用时删除
+    tasks = set()
+    
+    async def handle_frame(frame):
+        try:
+            frame_id = frame.get("id")
+            request_id = f"{connection_id}-{frame_id}" if frame_id is not None else None
+            lane = action_lane(frame)
+            if lane:
+                # 同一机器人的请求按接收顺序执行
+                entry = lane_locks.get(lane)
+                if entry is None:
+                    entry = lane_locks[lane] = [asyncio.Lock(), 0]
+                entry[1] += 1
+                try:
+                    async with entry[0]:
+                        response = await run_action(frame, request_id)
+                finally:
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del lane_locks[lane]
+            else:
+                response = await run_action(frame, request_id)
+            async with send_lock:
+                await websocket.send_text(json_dumps({"id": frame_id, **response}))
+        except Exception as e:
+            logger.error(f"WebSocket请求处理失败: {e}")
+        finally:
+            inflight.release()
+    
+    try:
+        while True:
+            # 处理中的请求达到上限时暂停读取，由TCP实现背压
+            await inflight.acquire()
+            try:
+                text = await receive_text()
+            except BaseException:
+                inflight.release()
+                raise
+            try:
+                if text is None:
+                    raise ValueError("只支持文本帧")
+                frame = json_loads(text)
+                if not isinstance(frame, dict):
+                    raise ValueError("请求帧必须是JSON对象")
+            except Exception as e:
+                inflight.release()
+                async with send_lock:
+                    await websocket.send_text(json_dumps({"id": None, "success": False, "status": 400, "error": f"无效的请求帧: {e}"}))
+                continue
+            
+            task = asyncio.create_task(handle_frame(frame))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    except WebSocketDisconnect:
+        logger.info("WebSocket连接已断开")
+    finally:
+        for task in tasks:
+            task.cancel()
 
 # ==================== 直接处理函数 ====================
-async def handle_query_direct(request_data: Dict[str, Any]):
+async def handle_query_direct(req: QueryRequest):
     """处理查询请求"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
-    groupid = request_data.get("groupid")
-    msg = request_data.get("msg", "")
-    mode = int(request_data.get("mode", 0))  # 默认为模糊匹配
+    botid = req.botid
+    userid = req.userid
+    groupid = req.groupid
+    msg = req.msg
+    segments = req.message  # 可选，OneBot消息段数组
+    mode = req.mode  # 默认为模糊匹配
     
     logger.info(f"查询请求: botid={botid}, userid={userid}, msg='{msg}', mode={mode}")
     
@@ -3050,12 +5044,16 @@ async def handle_query_direct(request_data: Dict[str, Any]):
     data_file = f"M_{userid}"
     await _global_file(botid, userid, groupid, data_file)
     
-    # 转换消息
-    message = _transcoding(msg)
-    logger.debug(f"转换后的消息: '{message}'")
+    # 转换消息（消息段数组无需经过CQ码解析）
+    if isinstance(segments, list):
+        message = _segments_to_text(segments)
+    else:
+        message = _transcoding(msg)
+    decode_log.debug("转换后的消息: '%s'", message)
     
     # 查询关键词
-    otext = await lexicon_operation(botid, "get", value=message)
+    with trace_stage("match"):
+        otext, _, _ = await lexicon_operation(botid, "get", value=message)
     
     if not otext:
         logger.info(f"未找到匹配的词条: '{message}'")
@@ -3084,16 +5082,18 @@ async def handle_query_direct(request_data: Dict[str, Any]):
         "timestamp": time.time()
     }
 
-async def handle_decode_direct(request_data: Dict[str, Any]):
+async def handle_decode_direct(req: DecodeRequest):
     """处理解码请求 - 支持完整的变量替换"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
-    groupid = request_data.get("groupid")
-    text = request_data.get("text", "")
-    lexicon_id = int(request_data.get("lexicon_id", 0))
-    lexicon_n = int(request_data.get("lexicon_n", 0))
-    event_data = request_data.get("event_data", {})
-    cool_config = request_data.get("cool_config", True)
+    botid = req.botid
+    userid = req.userid
+    groupid = req.groupid
+    text = req.text
+    if req.message is not None:
+        text = _segments_to_text(req.message)
+    lexicon_id = req.lexicon_id
+    lexicon_n = req.lexicon_n
+    event_data = req.event_data
+    cool_config = req.cool_config
     
     logger.info(f"解码请求: botid={botid}, text='{text[:50]}...', lexicon_id={lexicon_id}")
     
@@ -3117,16 +5117,142 @@ async def handle_decode_direct(request_data: Dict[str, Any]):
     )
     
     logger.info(f"解码完成: 类型={result.get('type')}")
-    return {
+    response = {
         "success": True,
         "action": "decode",
         "result": result,
         "timestamp": time.time()
     }
+    if req.segments:
+        response["message"] = _result_to_segments(result)
+    return response
+
+async def handle_decode_batch_direct(req: DecodeBatchRequest):
+    """处理批量解码请求 - 多条回复共用一次上下文初始化"""
+    botid = req.botid
+    userid = req.userid
+    groupid = req.groupid
+    texts = req.texts
+    lexicon_n = req.lexicon_n
+    event_data = req.event_data
+    cool_config = req.cool_config
+    with_segments = req.segments
+    
+    logger.info(f"批量解码请求: botid={botid}, 条数={len(texts)}")
+    
+    if not botid or not userid:
+        logger.error("缺少botid或userid参数")
+        raise HTTPException(status_code=400, detail="缺少botid或userid参数")
+    
+    # 初始化全局信息（整批只执行一次）
+    data_file = f"M_{userid}"
+    await _global_file(botid, userid, groupid, data_file)
+    
+    results = []
+    for index, item in enumerate(texts):
+        try:
+            # 每项可以是文本，也可以是带lexicon_id的对象
+            batch_item = DecodeBatchItem.model_validate(item if isinstance(item, dict) else {"text": item})
+            text = batch_item.text
+            if batch_item.message is not None:
+                text = _segments_to_text(batch_item.message)
+            
+            result = await _decoding(
+                botid,
+                text,
+                groupid,
+                cool_config,
+                batch_item.lexicon_id,
+                lexicon_n if batch_item.lexicon_n is None else batch_item.lexicon_n,
+                event_data
+            )
+            item_result = {"index": index, "success": True, "result": result}
+            if with_segments:
+                item_result["message"] = _result_to_segments(result)
+            results.append(item_result)
+        except Exception as e:
+            logger.error(f"批量解码第 {index} 项失败: {e}")
+            results.append({"index": index, "success": False, "error": str(e)})
+    
+    success_count = sum(1 for r in results if r["success"])
+    logger.info(f"批量解码完成: 成功={success_count}, 失败={len(results) - success_count}")
+    return {
+        "success": True,
+        "action": "decode_batch",
+        "results": results,
+        "count": len(results),
+        "timestamp": time.time()
+    }
+
+async def handle_respond_direct(req: RespondRequest):
+    """处理一站式回复请求 - 转码、查询、解码一次完成"""
+    event = req.event
+    # 事件中的ID与请求模型同样转换，无法识别时按缺少参数处理
+    botid = req.botid or BotActionRequest.validate_ids(event.get("self_id"))
+    userid = req.userid or BotActionRequest.validate_ids(event.get("user_id"))
+    groupid = req.groupid or event.get("group_id")
+    lexicon_n = req.lexicon_n
+    cool_config = req.cool_config
+    
+    logger.info(f"回复请求: botid={botid}, userid={userid}, groupid={groupid}")
+    
+    if not botid or not userid:
+        logger.error("缺少botid或userid参数")
+        raise HTTPException(status_code=400, detail="缺少botid或userid参数")
+    
+    # 初始化全局信息（只执行一次）
+    data_file = f"M_{userid}"
+    await _global_file(botid, userid, groupid, data_file)
+    
+    # 转换消息：优先使用消息段数组，其次是CQ码字符串
+    segments = req.message if req.message is not None else event.get("message")
+    if isinstance(segments, list):
+        message = _segments_to_text(segments)
+    else:
+        msg = req.msg or event.get("raw_message") or segments or ""
+        message = _transcoding(msg)
+    decode_log.debug("转换后的消息: '%s'", message)
+    
+    # 查询关键词
+    with trace_stage("match"):
+        otext, lexicon_id, _ = await lexicon_operation(botid, "get", value=message)
+    
+    if not otext:
+        logger.info(f"未找到匹配的词条: '{message}'")
+        return {
+            "success": True,
+            "action": "respond",
+            "found": False,
+            "timestamp": time.time()
+        }
+    
+    # 解码回复
+    result = await _decoding(
+        botid,
+        otext,
+        groupid,
+        cool_config,
+        lexicon_id,
+        lexicon_n,
+        event if req.event_data is None else req.event_data
+    )
+    
+    logger.info(f"回复完成: 词条ID={lexicon_id}, 类型={result.get('type')}")
+    response = {
+        "success": True,
+        "action": "respond",
+        "found": True,
+        "lexicon_id": lexicon_id,
+        "result": result,
+        "timestamp": time.time()
+    }
+    if req.segments:
+        response["message"] = _result_to_segments(result)
+    return response
 
-async def handle_transcode_direct(request_data: Dict[str, Any]):
+async def handle_transcode_direct(req: TranscodeRequest):
     """处理转码请求 - CQ码转内部格式"""
-    text = request_data.get("text", "")
+    text = req.text
     
     logger.info(f"转码请求: text='{text[:50]}...'")
     
@@ -3140,13 +5266,13 @@ async def handle_transcode_direct(request_data: Dict[str, Any]):
         "timestamp": time.time()
     }
 
-async def handle_add_direct(request_data: Dict[str, Any]):
+async def handle_add_direct(req: AddRequest):
     """处理添加词条请求"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
-    keyword = request_data.get("keyword")
-    reply = request_data.get("reply")
-    mode = int(request_data.get("mode", 1))  # 默认为精确匹配
+    botid = req.botid
+    userid = req.userid
+    keyword = req.keyword
+    reply = req.reply
+    mode = req.mode
     
     if not all([botid, userid, keyword, reply]):
         logger.error("添加词条缺少必要参数")
@@ -3178,7 +5304,8 @@ async def handle_add_direct(request_data: Dict[str, Any]):
     
     if isinstance(result, str):
         # 保存到文件
-        save_result = await file_control(botid, data_files[botid], "w", result)
+        with trace_stage("persist"):
+            save_result = await file_control(botid, data_files[botid], "w", result)
         if save_result == "写入成功":
             logger.info(f"词条保存成功: '{keyword}'")
             return {
@@ -3196,11 +5323,11 @@ async def handle_add_direct(request_data: Dict[str, Any]):
     logger.error(f"添加词条未知错误: '{keyword}'")
     raise HTTPException(status_code=500, detail="添加失败")
 
-async def handle_remove_direct(request_data: Dict[str, Any]):
+async def handle_remove_direct(req: RemoveRequest):
     """处理删除词条请求"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
-    keyword = request_data.get("keyword")
+    botid = req.botid
+    userid = req.userid
+    keyword = req.keyword
     
     if not all([botid, userid, keyword]):
         logger.error("删除词条缺少必要参数")
@@ -3220,7 +5347,8 @@ async def handle_remove_direct(request_data: Dict[str, Any]):
     
     if isinstance(result, str):
         # 保存到文件
-        save_result = await file_control(botid, data_files[botid], "w", result)
+        with trace_stage("persist"):
+            save_result = await file_control(botid, data_files[botid], "w", result)
         if save_result == "写入成功":
             logger.info(f"词条删除成功: '{keyword}'")
             return {
@@ -3237,12 +5365,12 @@ async def handle_remove_direct(request_data: Dict[str, Any]):
     logger.info(f"词条不存在: '{keyword}'")
     raise HTTPException(status_code=404, detail="词条不存在")
 
-async def handle_add_reply_direct(request_data: Dict[str, Any]):
+async def handle_add_reply_direct(req: AddReplyRequest):
     """处理添加回复选项"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
-    keyword = request_data.get("keyword")
-    reply = request_data.get("reply")
+    botid = req.botid
+    userid = req.userid
+    keyword = req.keyword
+    reply = req.reply
     
     if not all([botid, userid, keyword, reply]):
         logger.error("添加回复缺少必要参数")
@@ -3263,7 +5391,8 @@ async def handle_add_reply_direct(request_data: Dict[str, Any]):
     
     if isinstance(result, str):
         # 保存到文件
-        save_result = await file_control(botid, data_files[botid], "w", result)
+        with trace_stage("persist"):
+            save_result = await file_control(botid, data_files[botid], "w", result)
         if save_result == "写入成功":
             logger.info(f"回复添加成功: '{keyword}' -> '{reply}'")
             return {
@@ -3280,12 +5409,12 @@ async def handle_add_reply_direct(request_data: Dict[str, Any]):
     logger.info(f"词条不存在: '{keyword}'")
     raise HTTPException(status_code=404, detail="词条不存在")
 
-async def handle_remove_reply_direct(request_data: Dict[str, Any]):
+async def handle_remove_reply_direct(req: RemoveReplyRequest):
     """处理删除回复选项"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
-    keyword = request_data.get("keyword")
-    reply = request_data.get("reply")
+    botid = req.botid
+    userid = req.userid
+    keyword = req.keyword
+    reply = req.reply
     
     if not all([botid, userid, keyword, reply]):
         logger.error("删除回复缺少必要参数")
@@ -3306,7 +5435,8 @@ async def handle_remove_reply_direct(request_data: Dict[str, Any]):
     
     if isinstance(result, str):
         # 保存到文件
-        save_result = await file_control(botid, data_files[botid], "w", result)
+        with trace_stage("persist"):
+            save_result = await file_control(botid, data_files[botid], "w", result)
         if save_result == "写入成功":
             logger.info(f"回复删除成功: '{keyword}' -> '{reply}'")
             return {
@@ -3323,10 +5453,10 @@ async def handle_remove_reply_direct(request_data: Dict[str, Any]):
     logger.info(f"词条或回复不存在: '{keyword}' -> '{reply}'")
     raise HTTPException(status_code=404, detail="词条或回复不存在")
 
-async def handle_get_config_direct(request_data: Dict[str, Any]):
+async def handle_get_config_direct(req: GetConfigRequest):
     """获取配置信息"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
+    botid = req.botid
+    userid = req.userid
     
     if not all([botid, userid]):
         logger.error("获取配置缺少botid或userid参数")
@@ -3358,11 +5488,11 @@ async def handle_get_config_direct(request_data: Dict[str, Any]):
         "timestamp": time.time()
     }
 
-async def handle_search_direct(request_data: Dict[str, Any]):
+async def handle_search_direct(req: SearchRequest):
     """搜索关键词"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
-    keyword = request_data.get("keyword")
+    botid = req.botid
+    userid = req.userid
+    keyword = req.keyword
     
     if not all([botid, userid, keyword]):
         logger.error("搜索关键词缺少必要参数")
@@ -3374,33 +5504,34 @@ async def handle_search_direct(request_data: Dict[str, Any]):
     data_file = f"M_{userid}"
     await _global_file(botid, userid, None, data_file)
     
-    results = []
-    bot_data = datas.get(botid, {"work": []})
-    
-    for idx, item in enumerate(bot_data["work"], 1):
-        for key in item.keys():
-            if keyword in key:
-                results.append({
-                    "id": idx,
-                    "keyword": key,
-                    "reply_count": len(item[key].get("r", [])),
-                    "mode": item[key].get("s", 0)
-                })
+    # 通过n-gram索引筛选候选词条
+    work = datas.get(botid, {"work": []})["work"]
+    hits = get_lexicon_index(botid).search(work, keyword)
     
-    logger.info(f"搜索完成: 找到 {len(results)} 个结果")
+    results = []
+    for idx, key in hits[:req.limit]:
+        value = work[idx - 1][key]
+        results.append({
+            "id": idx,
+            "keyword": key,
+            "reply_count": len(value.get("r", [])),
+            "mode": value.get("s", 0)
+        })
+    
+    logger.info(f"搜索完成: 找到 {len(hits)} 个结果")
     return {
         "success": True,
         "action": "search",
         "keyword": keyword,
         "results": results,
-        "count": len(results),
+        "count": len(hits),
         "timestamp": time.time()
     }
 
-async def handle_list_direct(request_data: Dict[str, Any]):
+async def handle_list_direct(req: ListRequest):
     """列出词条"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
+    botid = req.botid
+    userid = req.userid
     
     if not all([botid, userid]):
         logger.error("列出词条缺少botid或userid参数")
@@ -3412,33 +5543,60 @@ async def handle_list_direct(request_data: Dict[str, Any]):
     data_file = f"M_{userid}"
     await _global_file(botid, userid, None, data_file)
     
-    bot_data = datas.get(botid, {"work": []})
+    offset = decode_list_cursor(req.cursor) if req.cursor else req.offset
+    work = datas.get(botid, {"work": []})["work"]
+    total = len(work)
+    
+    # 只构建当前页的词条
+    end = min(offset + req.limit, total)
     items = []
+    for idx in range(offset, end):
+        items.extend(_list_entries(idx + 1, work[idx]))
     
-    for idx, item in enumerate(bot_data["work"], 1):
-        for key, value in item.items():
-            items.append({
-                "id": idx,
-                "keyword": key,
-                "mode": value.get("s", 0),
-                "replies": value.get("r", []),
-                "reply_count": len(value.get("r", []))
-            })
+    next_cursor = encode_list_cursor(end) if end < total else None
     
-    logger.info(f"列出词条完成: 共 {len(items)} 个词条")
+    logger.info(f"列出词条完成: 共 {total} 个词条, 返回 {offset + 1}-{end}")
     return {
         "success": True,
         "action": "list",
-        "count": len(items),
-        "items": items[:100],  # 限制返回数量
-        "total": len(items),
+        "count": total,
+        "items": items,
+        "total": total,
+        "offset": offset,
+        "limit": req.limit,
+        "next_cursor": next_cursor,
         "timestamp": time.time()
     }
 
-async def handle_count_direct(request_data: Dict[str, Any]):
+def _list_entries(idx, item):
+    """把词库中的一项转换为list输出格式"""
+    return [{
+        "id": idx,
+        "keyword": key,
+        "mode": value.get("s", 0),
+        "replies": value.get("r", []),
+        "reply_count": len(value.get("r", []))
+    } for key, value in item.items()]
+
+def encode_list_cursor(offset):
+    """生成list分页游标"""
+    return base64.urlsafe_b64encode(f"o:{offset}".encode()).decode().rstrip("=")
+
+def decode_list_cursor(cursor):
+    """解析list分页游标"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        prefix, offset = raw.split(":", 1)
+        if prefix != "o" or not offset.isdigit():
+            raise ValueError(raw)
+        return int(offset)
+    except Exception:
+        raise HTTPException(status_code=400, detail="无效的分页游标")
+
+async def handle_count_direct(req: CountRequest):
     """统计词条数量"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
+    botid = req.botid
+    userid = req.userid
     
     logger.info(f"统计词数: botid={botid}, userid={userid}")
     
@@ -3450,13 +5608,10 @@ async def handle_count_direct(request_data: Dict[str, Any]):
     data_file = f"M_{userid}"
     await _global_file(botid, userid, None, data_file)
     
-    bot_data = datas.get(botid, {"work": []})
-    total_keywords = len(bot_data["work"])
-    
-    total_replies = 0
-    for item in bot_data["work"]:
-        for value in item.values():
-            total_replies += len(value.get("r", []))
+    # 使用词库索引维护的计数
+    index = get_lexicon_index(botid)
+    total_keywords = index.keyword_count
+    total_replies = index.reply_count
     
     logger.info(f"统计完成: 关键词={total_keywords}, 回复={total_replies}")
     
@@ -3468,10 +5623,10 @@ async def handle_count_direct(request_data: Dict[str, Any]):
         "timestamp": time.time()
     }
 
-async def handle_test_direct(request_data: Dict[str, Any]):
+async def handle_test_direct(req: TestRequest):
     """测试接口"""
-    botid = int(request_data.get("botid", 0))
-    userid = int(request_data.get("userid", 0))
+    botid = req.botid
+    userid = req.userid
     
     logger.info(f"测试接口: botid={botid}, userid={userid}")
     
@@ -3493,10 +5648,10 @@ async def handle_test_direct(request_data: Dict[str, Any]):
         ]
     }
 
-async def handle_admin_manage_direct(request_data: Dict[str, Any]):
+async def handle_admin_manage_direct(req: AdminManageRequest):
     """管理员管理"""
-    op = request_data.get("op", "view")
-    user = request_data.get("user")
+    op = req.op
+    user = req.user
     
     if op == "view":
         admin_list = ADMIN_IDS
@@ -3546,6 +5701,25 @@ async def handle_admin_manage_direct(request_data: Dict[str, Any]):
     else:
         raise HTTPException(status_code=400, detail="不支持的操作类型")
 
+# action -> 处理函数
+ACTION_HANDLERS = {
+    "query": handle_query_direct,
+    "decode": handle_decode_direct,
+    "decode_batch": handle_decode_batch_direct,
+    "respond": handle_respond_direct,
+    "add": handle_add_direct,
+    "remove": handle_remove_direct,
+    "remove_r": handle_remove_reply_direct,
+    "add_r": handle_add_reply_direct,
+    "get_config": handle_get_config_direct,
+    "search": handle_search_direct,
+    "list": handle_list_direct,
+    "count": handle_count_direct,
+    "test": handle_test_direct,
+    "transcode": handle_transcode_direct,
+    "admin_manage": handle_admin_manage_direct,
+}
+
 # ==================== 示例API调用 ====================
 @api_app.get("/api/v1/examples")
 async def get_examples():